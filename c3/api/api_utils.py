@@ -1,80 +1,844 @@
+import time
+import hashlib
 import requests
 import logging
+import itertools
+import threading
+import c3.io.checkpoint as c3checkpoint
+import c3.io.response_cache as c3response_cache
+import c3.api.transport as c3transport
+import c3.api.throttle as c3throttle
+import c3.api.singleflight as c3singleflight
+import c3.api.stats as c3stats
+import c3.api.endpoints as c3endpoints
+import c3.json.decode as c3decode
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from http.client import IncompleteRead
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# request parameters which do not change the response
+ignored_params = ['username', 'api_key']
+
+
+def strip_credentials(url):
+    """
+    Remove the credentials from the query string of url, e.g. a next link
+    carrying every request parameter.
+
+    :param url: url of a request
+    :return: url without username and api_key
+    """
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    query = [(key, value) for key, value
+             in parse_qsl(parts.query, keep_blank_values=True)
+             if key not in ignored_params]
+
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def request_key(url, params=None):
+    """
+    Get the key of a request regardless of the order of params and
+    without the credentials.
+
+    The response cache, the single flight, the checkpoints and the
+    cassettes all key their requests by it.
+
+    :param url: url of the request
+    :param params: request parameters
+    :return: tuple of the url and the sorted (name, value) strings
+    """
+    key_params = tuple(sorted((str(key), str(value))
+                              for key, value in (params or {}).items()
+                              if key not in ignored_params))
+
+    return strip_credentials(url), key_params
+
+
+def request_digest(url, params=None):
+    """
+    Get request_key of a request as a hex digest.
+
+    :return: string
+    """
+    url, key_params = request_key(url, params)
+    key = url + '?' + '&'.join('{}={}'.format(*param)
+                               for param in key_params)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
 
 class QueryError(Exception):
-    def __init__(self, value):
+    def __init__(self, value, status_code=None):
         self.value = value
+        # HTTP status code of the failed response if there is one
+        self.status_code = status_code
 
     def __str__(self):
         return repr(self.value)
 
 
+class CircuitOpenError(QueryError):
+    """
+    The endpoint failed too many times in a row and is not queried for a
+    while.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast on an endpoint which keeps failing.
+
+    After threshold consecutive failures the circuit opens and every
+    request raises CircuitOpenError without being sent. After cooldown
+    seconds the circuit is half open and lets probes requests through.
+    A successful probe closes the circuit, a failed one opens it again.
+    A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name, threshold=5, cooldown=60.0, probes=1):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probes = probes
+        self.failures = 0
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self.lock = threading.Lock()
+
+    def before(self):
+        """
+        Ask to send a request.
+
+        :return: True if the request is a probe of the half open circuit
+        """
+        if not self.threshold:
+            return False
+
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at >= self.cooldown and \
+               self.probes_in_flight < self.probes:
+                self.probes_in_flight += 1
+                logging.info('Probe endpoint {}'.format(self.name))
+                return True
+
+        raise CircuitOpenError("Circuit of endpoint {} is open after {} "
+                               "failures.".format(self.name, self.failures))
+
+    def reopen_in(self):
+        """
+        :return: seconds until the open circuit lets a probe through, 0 if
+                 it is not open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def record(self, failed, probe=False):
+        if not self.threshold:
+            return
+
+        with self.lock:
+            if probe:
+                self.probes_in_flight -= 1
+            if not failed:
+                if self.opened_at is not None:
+                    logging.info('Close circuit of endpoint {}'
+                                 .format(self.name))
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            if probe or (self.opened_at is None and
+                         self.failures >= self.threshold):
+                logging.warning('Open circuit of endpoint {} for {} seconds'
+                                .format(self.name, self.cooldown))
+                self.opened_at = time.monotonic()
+
+
+# status codes worth to try again later
+retryable_status_codes = [408, 429, 500, 502, 503, 504]
+
+
+def is_retryable(result):
+    """
+    Tell whether a failed query is worth to try again later.
+
+    :param result: result of map_query
+    :return: True for QueryError without status code or with a status code
+             in retryable_status_codes
+    """
+    return isinstance(result, QueryError) and \
+        (result.status_code is None or
+         result.status_code in retryable_status_codes)
+
+
 class APIQuery:
 
-    def __init__(self, instance_uri, timeout=30.0, max_retries=10):
+    def __init__(self, instance_uri, timeout=30.0, max_retries=10,
+                 max_workers=1, page_window=None,
+                 checkpoint_dir='c3-checkpoints', resume=False,
+                 checkpoint_max_age=86400.0, pool_size=None, rate_limit=0,
+                 rate_burst=None, backoff_base=0.5, backoff_max=30.0,
+                 adaptive=False,
+                 response_cache=None, endpoints=None, hedge=False,
+                 hedge_ratio=0.05, breaker_threshold=5, breaker_cooldown=60.0,
+                 max_in_flight=None):
         self.instance_uri = instance_uri
-        self.session = requests.session()
         self.timeout = timeout
         self.max_retries = max_retries
+        # timeouts, retries, cache ttl and concurrency cap of each endpoint,
+        # timeout and max_retries for endpoints without a profile
+        if endpoints is None:
+            endpoints = c3endpoints.EndpointRegistry(timeout, max_retries)
+        self.endpoints = endpoints
+        self.endpoint_slots = {}
+        self.endpoint_slots_lock = threading.Lock()
+        self.max_workers = max_workers
+        # how many pages of a batch query are fetched at the same time
+        if page_window is None:
+            page_window = max_workers
+        self.page_window = page_window
+        # every worker should find a connection to keep alive in the pool
+        if pool_size is None:
+            pool_size = max(10, max_workers, page_window)
+        self.transport = c3transport.Transport(pool_size=pool_size,
+                                               timeout=timeout)
+        # requests per second of all threads, 0 for no limit
+        self.limiter = c3throttle.TokenBucket(rate_limit, rate_burst)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.single_flight = c3singleflight.SingleFlight()
+        # ResponseCache of the endpoints with a cache ttl
+        self.response_cache = response_cache
+        # requests in flight, adjusted by the responses if adaptive, the
+        # waiting requests are served by their priority classes
+        if adaptive:
+            self.concurrency = c3throttle.AIMDController(
+                max_window=max(max_workers, page_window))
+        else:
+            self.concurrency = c3throttle.ConcurrencyLimiter(max_in_flight)
+        # priority class of the requests sent by each thread
+        self.local = threading.local()
+        # where to keep the checkpoints of batch queries, None to disable
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+        # seconds a checkpoint could be resumed from, None for ever
+        self.checkpoint_max_age = checkpoint_max_age
+        # requests, retries, status codes, bytes and latencies per endpoint
+        self.stats = c3stats.RequestStats()
+        # recent latencies and circuit breaker of each endpoint
+        self.latencies = {}
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        # duplicate slow GETs, at most hedge_ratio of all GETs
+        self.hedge = hedge
+        self.hedge_ratio = hedge_ratio
+        self.hedge_lock = threading.Lock()
+        self.sent_count = 0
+        self.hedged_count = 0
+        self.hedge_executor = None
+        if hedge:
+            self.hedge_executor = ThreadPoolExecutor(
+                max_workers=2 * max(max_workers, page_window) + 2)
+
+    def batch_query(self, url, params=None, **kwargs):
+        """
+        Query every page of a list endpoint and return all the objects.
+
+        :param url: url of the list endpoint
+        :param params: request parameters
+        :return: list of objects of all pages
+        """
+        return list(self.iter_batch_query(url, params, **kwargs))
+
+    def iter_batch_query(self, url, params=None, **kwargs):
+        """
+        Query every page of a list endpoint and yield the objects page by page.
+
+        The first page tells the total count and the page size, so the
+        remaining pages are known up front and fetched concurrently,
+        page_window pages at a time, then yielded in order. If the
+        server does not tell them, the meta next links are followed one
+        by one instead.
+
+        Objects could be projected down to fields passed by the fields
+        keyword to save memory.
+
+        Only one window of pages is held in memory at a time. Every page
+        is also appended to a checkpoint in checkpoint_dir, so a query
+        failing in the middle could be resumed from the failed page by
+        setting resume. The checkpoint is kept only if the query fails,
+        and one older than checkpoint_max_age is not resumed from.
+
+        Pages are bulk requests unless the priority keyword tells
+        otherwise.
+
+        :param url: url of the list endpoint
+        :param params: request parameters
+        :return: generator of objects
+        """
+        params = dict(params or {})
+        kwargs.setdefault('priority', c3throttle.BULK)
+
+        checkpoint_fn = None
+        records = []
+        if self.checkpoint_dir:
+            checkpoint_fn = c3checkpoint.get_checkpoint_fn(
+                self.checkpoint_dir, request_digest(url, params))
+            if self.resume:
+                records = c3checkpoint.read_checkpoint(
+                    checkpoint_fn, self.checkpoint_max_age)
+
+        if records:
+            logging.info('Resume {} from checkpoint {}'.format(url,
+                                                               checkpoint_fn))
+            for record in records:
+                for obj in record['objects']:
+                    yield obj
+            state = records[-1]['state']
+            del records
+            first_page = None
+        else:
+            first_page = self._get(url, params, **kwargs)
+            state = self._page_state(first_page['meta'])
+
+        checkpoint = None
+        if checkpoint_fn:
+            checkpoint = c3checkpoint.open_checkpoint(
+                checkpoint_fn, append=first_page is None)
+        try:
+            if first_page is not None:
+                pages = [(first_page['objects'], state)]
+                del first_page
+            else:
+                pages = []
+            pages = itertools.chain(pages,
+                                    self._iter_next_pages(url, params, state,
+                                                          **kwargs))
+            for objects, state in pages:
+                if checkpoint:
+                    c3checkpoint.write_checkpoint(checkpoint,
+                                                  {'objects': objects,
+                                                   'state': state})
+                for obj in objects:
+                    yield obj
+        except QueryError:
+            if checkpoint:
+                logging.warning('Downloaded pages are kept in {}. Resume '
+                                'from there with --resume.'
+                                .format(checkpoint_fn))
+                checkpoint.close()
+                checkpoint = None
+            raise
+        finally:
+            # done, or the caller stopped early, e.g. GeneratorExit
+            if checkpoint:
+                checkpoint.close()
+                c3checkpoint.remove_checkpoint(checkpoint_fn)
+
+    def _iter_next_pages(self, url, params, state, **kwargs):
+        """
+        Yield the objects and the state of every page after the given state.
+        """
+        if state['offset'] is not None:
+            limit = state['limit']
+            offsets = list(range(state['offset'], state['total_count'],
+                                 limit))
+            params = dict(params, limit=limit)
+            pages = self._iter_pages(url, params, offsets, **kwargs)
+            for offset, page in zip(offsets, pages):
+                yield page['objects'], dict(state, offset=offset + limit)
+            return
 
-    def batch_query(self, *args, **kwargs):
-        results = []
-        kwargs['timeout'] = self.timeout
-        next_query = None
         # Continue until a request entirely fails
         # or we don't get a request for another chunk
-        while True:
-            if next_query:
-                args = (self.instance_uri + next_query,) + args[:-1]
-            success = False
-            for tries in range(self.max_retries):
-                try:
-                    if next_query:
-                        # Using kwargs causes a bug with next_query
-                        batch = self.session.get(*args)
-                    else:
-                        batch = self.session.get(*args, **kwargs)
-                    if batch.ok:
-                        # json is callable in requests >= 1.0
-                        if callable(batch.json):
-                            decoded_content = batch.json()
-                        else:
-                            decoded_content = batch.json
-                        results.extend(decoded_content["objects"])
-                        success = True
-                        next_query = decoded_content['meta']['next']
-                        break
-                except (IncompleteRead,
-                        ValueError,
-                        requests.exceptions.ConnectionError,
-                        requests.exceptions.Timeout) as excp:
-                    logging.warning(excp)
-            if not success:
-                raise QueryError("Could not query {} succesfully "
-                                 "after {} tries.".format(self.instance_uri,
-                                                          self.max_retries))
-            if not next_query:
-                break
-        return results
+        next_query = state['next']
+        while next_query:
+            # next_query carries every request parameter already
+            page = self._get(self.instance_uri + next_query, **kwargs)
+            next_query = page['meta']['next']
+            yield page['objects'], dict(state, next=next_query)
+
+    def single_query(self, url, params=None, **kwargs):
+        """
+        GET url and return the decoded json.
+
+        Identical requests in flight at the same time are sent once and
+        share the same decoded json, so callers should not modify it.
+
+        The request is interactive unless it is made in map_query or the
+        priority keyword tells otherwise.
+
+        :param url: url of the resource
+        :param params: request parameters
+        :param fields: fields to keep, e.g. ['release.release'], None to
+                       keep all
+        :return: decoded json
+        """
+        key = request_key(url, params) + \
+            (tuple(kwargs.get('fields') or ()),)
+
+        return self.single_flight.do(
+            key, lambda: self._get(url, params, **kwargs))
+
+    def push(self, url, params=None, data=None, headers=None, endpoint=None,
+             **kwargs):
+        """
+        PATCH url with data, retry up to the max retries of endpoint if the
+        request could not be sent or the server asks to try again later.
+
+        :return: response of the request
+        """
+        if self.response_cache is not None:
+            # the resource and the lists it is in
+            self.response_cache.invalidate(url)
+            self.response_cache.invalidate(url.rstrip('/').rsplit('/', 1)[0])
+
+        max_retries = self.endpoints.get(endpoint).max_retries
+        result = None
+        for tries in range(max_retries):
+            if tries:
+                self.stats.record_retry(endpoint or 'other')
+                self._wait_to_retry(tries, result)
+            result = self._send('PATCH', url, endpoint=endpoint,
+                                params=params, data=data, headers=headers,
+                                **kwargs)
+            if result is not None and \
+               result.status_code not in retryable_status_codes:
+                return result
+        raise QueryError("Could not push {} succesfully "
+                         "after {} tries.".format(url, max_retries))
+
+    def _get(self, url, params=None, endpoint=None, fields=None, **kwargs):
+        """
+        GET url and return the decoded json.
+
+        If the response cache keeps the responses of endpoint, a fresh
+        cached response is used instead of querying C3. A stale one is
+        revalidated by a conditional request with its ETag or
+        Last-Modified, and used again if C3 answers 304 Not Modified.
+
+        :param endpoint: endpoint name to look up the cache ttl
+        :param fields: fields to keep in each object, None to keep all
+        """
+        ttl = self._cache_ttl(endpoint)
+        if not ttl:
+            return self._fetch(url, params, endpoint=endpoint, fields=fields,
+                               **kwargs)[1]
+
+        key = request_digest(url, params)
+        entry = self.response_cache.lookup(key)
+        if entry is not None and c3response_cache.is_fresh(entry, ttl):
+            logging.debug('Use cached response of {}'.format(url))
+            return self._decode(entry['body'], fields)
+
+        if entry is not None:
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            kwargs['headers'] = headers
+
+        result, decoded_content = self._fetch(url, params, endpoint=endpoint,
+                                              fields=fields, **kwargs)
+
+        if result.status_code == 304:
+            logging.debug('Cached response of {} is not modified'.format(url))
+            self.response_cache.touch(key)
+            return self._decode(entry['body'], fields)
+
+        etag = result.headers.get('ETag')
+        last_modified = result.headers.get('Last-Modified')
+        if entry is not None and not (etag or last_modified) and \
+           entry['body_hash'] == c3response_cache.body_hash(result.content):
+            logging.info('{} is not changed but downloaded again for no '
+                         'validators, {} bytes'.format(url,
+                                                       len(result.content)))
+        self.response_cache.set(key, strip_credentials(url),
+                                result.content, etag=etag,
+                                last_modified=last_modified)
+
+        return decoded_content
 
-    def single_query(self, *args, **kwargs):
-        kwargs['timeout'] = self.timeout
-        for tries in range(self.max_retries):
+    def _fetch(self, url, params=None, endpoint=None, fields=None,
+               **kwargs):
+        """
+        GET url and decode the json, retry up to the max retries of endpoint.
+
+        Failures which will not go away by trying again, e.g. 404, raise
+        QueryError at once.
+
+        :return: response and its decoded json, None for 304 Not Modified
+        """
+        max_retries = self.endpoints.get(endpoint).max_retries
+        result = None
+        for tries in range(max_retries):
+            if tries:
+                self.stats.record_retry(endpoint or 'other')
+                self._wait_to_retry(tries, result)
+            result = self._send('GET', url, endpoint=endpoint, params=params,
+                                **kwargs)
+            if result is None:
+                continue
+            if result.status_code == 304:
+                return result, None
+            if not result.ok:
+                if result.status_code not in retryable_status_codes:
+                    raise QueryError("Could not query {}: HTTP {}".format(
+                        url, result.status_code), result.status_code)
+                continue
             try:
-                result = self.session.get(*args, **kwargs)
-                if result.ok:
-                    if callable(result.json):
-                        decoded_content = result.json()
-                    else:
-                        decoded_content = result.json
-                    return decoded_content
-            except(IncompleteRead,
-                   ValueError,
-                   requests.exceptions.ConnectionError,
-                   requests.exceptions.Timeout) as excp:
+                return result, self._decode(result.content, fields)
+            except ValueError as excp:
                 logging.warning(excp)
         raise QueryError("Could not query {} succesfully "
-                         "after {} tries.".format(self.instance_uri,
-                                                  self.max_retries))
+                         "after {} tries.".format(url, max_retries))
+
+    @staticmethod
+    def _decode(content, fields=None):
+        return c3decode.project_document(c3decode.loads(content), fields)
+
+    def _cache_ttl(self, endpoint):
+        """
+        Get the seconds to cache the responses of endpoint.
+
+        :return: seconds, negative for ever, 0 if not cached
+        """
+        if self.response_cache is None or endpoint is None:
+            return 0
+
+        return self.endpoints.get(endpoint).cache_ttl
+
+    def _wait_to_retry(self, tries, result):
+        """
+        Sleep before trying a request again.
+
+        Honour Retry-After of the last response if there is one, otherwise
+        back off exponentially with jitter.
+
+        :param tries: how many times the request has been tried
+        :param result: the last response, None if it was not received
+        """
+        delay = None
+        if result is not None:
+            delay = c3throttle.retry_after_delay(result)
+        if delay is None:
+            delay = c3throttle.backoff_delay(tries, self.backoff_base,
+                                             self.backoff_max)
+        else:
+            delay = min(delay, self.backoff_max)
+        logging.debug('Retry in {:.2f} seconds'.format(delay))
+        time.sleep(delay)
+
+    def _send(self, method, url, endpoint=None, priority=None, **kwargs):
+        """
+        Send a request, hedged if it is a GET and hedge is enabled.
+
+        A hedged GET not answered within the p95 latency of its endpoint
+        is sent again, and the first good response of the two is used.
+        Hedges are at most hedge_ratio of all GETs.
+
+        :param priority: INTERACTIVE or BULK, None for the priority of
+                         the current thread
+        :return: response, or None if it could not be received at all
+        """
+        if priority is None:
+            priority = getattr(self.local, 'priority', None) or \
+                c3throttle.INTERACTIVE
+        kwargs['priority'] = priority
+        if not self.hedge or method != 'GET':
+            return self._send_once(method, url, endpoint, **kwargs)
+
+        with self.hedge_lock:
+            self.sent_count += 1
+
+        delay = self._hedge_delay(endpoint)
+        if delay is None:
+            return self._send_once(method, url, endpoint, **kwargs)
+
+        primary = self.hedge_executor.submit(self._send_once,
+                                             method, url, endpoint, **kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        with self.hedge_lock:
+            allowed = self.hedged_count + 1 <= \
+                self.hedge_ratio * self.sent_count
+            if allowed:
+                self.hedged_count += 1
+        if not allowed:
+            return primary.result()
+
+        logging.debug('Hedge {} after {:.2f} seconds'.format(url, delay))
+        secondary = self.hedge_executor.submit(self._send_once,
+                                               method, url, endpoint, **kwargs)
+        pending = {primary, secondary}
+        result = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is not None and result.status_code < 500:
+                    return result
+
+        return result
+
+    def _hedge_delay(self, endpoint, min_samples=20):
+        """
+        Get the seconds to wait before hedging a request to endpoint.
+
+        :return: p95 latency of endpoint, None if not enough samples
+        """
+        latencies = self.latencies.get(endpoint)
+        if latencies is None or len(latencies) < min_samples:
+            return None
+
+        return latencies.percentile(95)
+
+    def _breaker(self, endpoint):
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.breakers_lock:
+                breaker = self.breakers.setdefault(
+                    endpoint,
+                    CircuitBreaker(endpoint, self.breaker_threshold,
+                                   self.breaker_cooldown))
+
+        return breaker
+
+    def _endpoint_slot(self, endpoint):
+        """
+        Get the limiter capping the requests in flight to endpoint.
+
+        Like the global gate, its waiters are served by their priority
+        classes, so a queued bulk request does not hold up the interactive
+        ones to the same endpoint.
+
+        :return: ConcurrencyLimiter, None if endpoint has no cap
+        """
+        slot = self.endpoint_slots.get(endpoint)
+        if slot is None:
+            concurrency = self.endpoints.get(endpoint).concurrency
+            if not concurrency:
+                return None
+            with self.endpoint_slots_lock:
+                slot = self.endpoint_slots.setdefault(
+                    endpoint, c3throttle.ConcurrencyLimiter(concurrency))
+
+        return slot
+
+    def _send_once(self, method, url, endpoint=None,
+                   priority=c3throttle.INTERACTIVE, **kwargs):
+        """
+        Send a request through the shared transport once.
+
+        CircuitOpenError is raised if the circuit of endpoint is open.
+
+        The endpoint cap is passed before the global concurrency gate, both
+        by priority, and the rate limiter after them, so requests queue for
+        tokens in the order the gates let them through.
+
+        :return: response, or None if it could not be received at all
+        """
+        kwargs['timeout'] = self.endpoints.get(endpoint).timeout
+        breaker = self._breaker(endpoint)
+        probe = breaker.before()
+        broken = True
+        try:
+            slot = self._endpoint_slot(endpoint)
+            if slot is not None:
+                slot.acquire(priority)
+            self.concurrency.acquire(priority)
+            self.limiter.acquire()
+            started_at = time.monotonic()
+            result = None
+            try:
+                result = self.transport.request(method, url, **kwargs)
+            except(IncompleteRead,
+                   requests.exceptions.RequestException) as excp:
+                # e.g. ChunkedEncodingError of a truncated page
+                logging.warning(excp)
+            finally:
+                self.concurrency.release()
+                if slot is not None:
+                    slot.release()
+            # being rate limited does not mean the endpoint is broken
+            broken = result is None or result.status_code >= 500
+        finally:
+            # always, or the probe is never given back and the circuit
+            # stays open
+            breaker.record(broken, probe)
+
+        latency = time.monotonic() - started_at
+        failed = result is None or result.status_code >= 500 or \
+            result.status_code == 429
+        self.concurrency.record(started_at, latency, failed)
+        self.stats.record_request(endpoint or 'other', result, latency)
+        if not failed:
+            self.latencies.setdefault(
+                endpoint, c3throttle.LatencyWindow()).add(latency)
+
+        return result
+
+    @staticmethod
+    def _page_state(meta):
+        """
+        Get what is needed to query the pages after the one described by meta.
+
+        offset is the offset of the next page, None if the pages after could
+        only be found by following the next links.
+
+        :param meta: tastypie meta of a page
+        :return: dictionary
+        """
+        state = {'next': meta['next'], 'offset': None,
+                 'limit': None, 'total_count': None}
+        try:
+            limit = int(meta['limit'])
+            offset = int(meta['offset'])
+            total_count = int(meta['total_count'])
+        except (KeyError, TypeError, ValueError):
+            return state
+
+        if meta['next'] and limit > 0:
+            state.update(offset=offset + limit, limit=limit,
+                         total_count=total_count)
+
+        return state
+
+    def _iter_pages(self, url, params, offsets, **kwargs):
+        """
+        Fetch the pages at offsets concurrently and yield them in order.
+
+        At most page_window pages are in flight at the same time. A page
+        failing after max_retries fails the whole query.
+        """
+        window = max(1, self.page_window)
+        for start in range(0, len(offsets), window):
+            page_params = [dict(params, offset=offset)
+                           for offset in offsets[start:start + window]]
+
+            def query(page_param):
+                return self._get(url, page_param, **kwargs)
+
+            window_pages = self.map_query(query, page_params,
+                                          max_workers=window)
+            for page in window_pages:
+                if isinstance(page, QueryError):
+                    raise page
+            for page in window_pages:
+                yield page
+
+    def map_query(self, func, items, max_workers=None,
+                  priority=c3throttle.BULK):
+        """
+        Apply func to every item concurrently and keep the input order.
+
+        A QueryError raised for one item does not abort the others. It is
+        logged and put in the result list at the position of the failed
+        item, so callers can tell failures apart with isinstance.
+
+        Requests made by func are bulk requests, so interactive requests
+        made meanwhile by other threads go ahead of them.
+
+        :param func: callable taking one item, usually a query function
+        :param items: iterable of items
+        :param max_workers: size of the thread pool, default self.max_workers
+        :param priority: priority class of the requests made by func
+        :return: list of results in the same order as items
+        """
+        items = list(items)
+        if max_workers is None:
+            max_workers = self.max_workers
+        max_workers = max(1, min(max_workers, len(items) or 1))
+
+        def call(item):
+            previous = getattr(self.local, 'priority', None)
+            self.local.priority = priority
+            try:
+                return func(item)
+            except QueryError as excp:
+                logging.warning("Failed to query {}: {}".format(item, excp))
+                return excp
+            finally:
+                self.local.priority = previous
+
+        if max_workers == 1:
+            return [call(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(call, items))
+
+    def map_query_deferred(self, func, items, max_workers=None,
+                           retry_rounds=1, retry_delay=None):
+        """
+        Like map_query, but retry the failed items after all the others.
+
+        Failed items are put in a retry queue instead of being retried at
+        once, so the rest goes on. When every item has been tried, the
+        queue is retried after retry_delay seconds, and every request gets
+        its whole retry budget again, or once the open circuits let probes
+        through if that is later. Failures which will not go away, e.g.
+        404, are not retried.
+
+        :param retry_rounds: times to retry the queue
+        :param retry_delay: seconds to wait before retrying the queue,
+                            default backoff_max
+        :return: list of results in the same order as items, QueryError
+                 for items failing every round
+        """
+        items = list(items)
+        if retry_delay is None:
+            retry_delay = self.backoff_max
+        results = self.map_query(func, items, max_workers=max_workers)
+
+        for _ in range(retry_rounds):
+            queue = [index for index, result in enumerate(results)
+                     if is_retryable(result)]
+            if not queue:
+                break
+            delay = retry_delay
+            if any(isinstance(results[index], CircuitOpenError)
+                   for index in queue):
+                # retrying before the cooldown hits the same open circuit
+                delay = max([delay] + [breaker.reopen_in() for breaker
+                                       in list(self.breakers.values())])
+            logging.info('Retry {} failed items in {:.1f} seconds'.format(
+                len(queue), delay))
+            time.sleep(delay)
+            retried = self.map_query(func, [items[index] for index in queue],
+                                     max_workers=max_workers)
+            for index, result in zip(queue, retried):
+                results[index] = result
+
+        return results
+
+    def map_single_query(self, urls, params=None, max_workers=None,
+                         **kwargs):
+        """
+        Run single_query for every url concurrently over the shared session.
+
+        :param urls: iterable of urls
+        :param params: request parameters shared by every url
+        :param max_workers: size of the thread pool, default self.max_workers
+        :return: list of decoded contents, or QueryError for failed urls
+        """
+        def query(url):
+            return self.single_query(url, params=params, **kwargs)
+
+        return self.map_query(query, urls, max_workers=max_workers)
@@ -0,0 +1,150 @@
+"""
+Record C3 responses to a cassette and replay them without network.
+
+A cassette is a directory with a file of json lines, one line per
+request: the request key, the status code, the headers, the latency and
+the zlib compressed body. Runs recorded into the same directory are
+appended to the same cassette.
+
+Requests are matched by method, url, parameters without the credentials
+and body. The credentials are not written to the cassette. Identical
+requests are replayed in the recorded order, and the last response is
+repeated once they run out.
+"""
+import os
+import json
+import time
+import zlib
+import base64
+import hashlib
+import logging
+import threading
+import collections
+import requests
+from requests.structures import CaseInsensitiveDict
+import c3.api.stats as c3stats
+
+
+logger = logging.getLogger('c3_web_query')
+
+cassette_name = 'c3.cassette.jsonl'
+
+# headers describing the body on the wire, which is stored decompressed
+dropped_headers = ['content-encoding', 'transfer-encoding', 'content-length']
+
+
+def request_key(method, url, params=None, data=None):
+    """
+    Get the key to match a replayed request to a recorded one.
+
+    :return: string
+    """
+    # api_utils imports the transport, which imports this module
+    import c3.api.api_utils as c3api_utils
+
+    key = method.upper() + ' ' + c3api_utils.request_digest(url, params)
+    if data:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        key += ' ' + hashlib.sha1(data).hexdigest()
+
+    return key
+
+
+class CassetteRecorder(object):
+    """
+    Session recording every response of session to the cassette in
+    directory.
+    """
+
+    def __init__(self, session, directory):
+        self.session = session
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, cassette_name)
+        self.lock = threading.Lock()
+        logger.info('Record C3 responses to {}'.format(self.path))
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        started_at = time.monotonic()
+        response = self.session.request(method, url, params=params,
+                                        data=data, **kwargs)
+        latency = time.monotonic() - started_at
+
+        body = response.content
+        headers = dict((name, value)
+                       for name, value in response.headers.items()
+                       if name.lower() not in dropped_headers)
+        # keep the wire size for the transfer stats of the replay
+        headers['Content-Length'] = str(c3stats.get_wire_bytes(response,
+                                                               len(body)))
+        # api_utils is loaded by now, see request_key
+        import c3.api.api_utils as c3api_utils
+
+        record = {'key': request_key(method, url, params, data),
+                  'url': c3api_utils.strip_credentials(url),
+                  'status_code': response.status_code,
+                  'headers': headers,
+                  'latency': latency,
+                  'body': base64.b64encode(zlib.compress(body)).decode(
+                      'ascii')}
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as handle:
+                handle.write(line)
+
+        return response
+
+
+class CassettePlayer(object):
+    """
+    Session serving the responses of the cassette in directory.
+
+    If latency is set, every response is delayed by its recorded latency.
+    A request not found in the cassette is answered by 404.
+    """
+
+    def __init__(self, directory, latency=False):
+        self.path = os.path.join(directory, cassette_name)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.records = collections.defaultdict(collections.deque)
+        with open(self.path) as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self.records[record['key']].append(record)
+        logger.info('Replay C3 responses from {}'.format(self.path))
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        key = request_key(method, url, params, data)
+        with self.lock:
+            records = self.records.get(key)
+            if records:
+                record = records[0]
+                if len(records) > 1:
+                    records.popleft()
+            else:
+                record = None
+
+        if record is None:
+            logger.warning('{} {} is not in the cassette'.format(method, url))
+            return make_response(url, 404, {}, b'')
+
+        if self.latency:
+            time.sleep(record['latency'])
+
+        return make_response(url, record['status_code'], record['headers'],
+                             zlib.decompress(base64.b64decode(
+                                 record['body'])))
+
+
+def make_response(url, status_code, headers, body):
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response.encoding = 'utf-8'
+
+    return response
@@ -5,6 +5,7 @@ Get ['CID', 'Release', 'Level', 'Location', 'Vendor'] list by
 querying certificates in Taipei Cert lab.
 """
 import os
+import hashlib
 import c3.config
 import pickle
 import logging
@@ -13,6 +14,7 @@ import collections
 import c3.maptable
 import c3.config as c3config
 import c3.io.cache as c3cache
+import c3.io.cid_list as c3cid_list
 import c3.api.query as c3q
 import c3.api.api as c3api
 import c3.pool.cid as c3cid
@@ -42,14 +44,52 @@ def get_cid_from_cert_lot_result(result):
 
 
 
-def get_certificates_by_location(location='Taipei', use_cache=True):
+def get_certificates_by_location(location='Taipei', use_cache=True,
+                                 filters=None, sync=None):
     """
     Get certificate information and the associated information by location api.
 
     :param location: string, e.g. Taipei
+    :param filters: tastypie filters passed to C3, None for no filter
+    :param sync: see iter_certificates_by_location
     :return: results
     """
-    pickle_fn = location.lower() + '.cert_by_location.pickle'
+    return list(iter_certificates_by_location(location, use_cache=use_cache,
+                                              filters=filters, sync=sync))
+
+
+def get_certificates_pickle_fn(location, filters=None):
+    """
+    Get the cache file name of the certificates of location.
+
+    Certificates queried with different filters are cached apart.
+    """
+    prefix = location.lower()
+    if filters:
+        key = repr(sorted((str(name), str(value))
+                          for name, value in filters.items()))
+        prefix += '-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+
+    return prefix + '.cert_by_location.pickle'
+
+
+def iter_certificates_by_location(location='Taipei', use_cache=True,
+                                  filters=None, sync=None):
+    """
+    Get certificates by location api and yield them page by page.
+
+    The whole result is held in memory only when it has to be written
+    to the cache.
+
+    :param location: string, e.g. Taipei
+    :param filters: tastypie filters passed to C3, None for no filter. C3
+                    could reject them, so filter the result locally too.
+    :param sync: merge the certificates created or changed since the cache
+                 was written into the cache before using it. None to follow
+                 cache_sync of [GENERAL].
+    :return: generator of certificates
+    """
+    pickle_fn = get_certificates_pickle_fn(location, filters)
 
     if configuration.config['GENERAL']['cache'] and use_cache:
         logger.info('Trying to find cache to get certificates by location.')
@@ -61,23 +101,142 @@ def get_certificates_by_location(location='Taipei', use_cache=True):
                 results = pickle.load(handle)
         except FileNotFoundError:
             logger.info('Cache not found. Fallback to web query.')
-            results = c3q.query_certificates_by_location(location)
+            results = []
+            for result in c3q.iter_certificates_by_location(location, filters):
+                results.append(result)
+                yield result
 
             with open(pickle_fn, 'wb') as handle:
                 cache_path = os.path.realpath(handle.name)
                 logger.info('Save cache at {}'.format(cache_path))
                 pickle.dump(results, handle)
+        else:
+            if sync is None:
+                sync = is_cache_synced()
+            if sync:
+                results = sync_certificates_by_location(location, results,
+                                                        filters)
+                with open(pickle_fn, 'wb') as handle:
+                    logger.info('Update cache at {}'.format(cache_path))
+                    pickle.dump(results, handle)
+
+            for result in results:
+                yield result
 
     else:
-        results = c3q.query_certificates_by_location(location)
+        for result in c3q.iter_certificates_by_location(location, filters):
+            yield result
 
-        if configuration.config['GENERAL']['cache'] and use_cache:
-            with open(pickle_fn, 'wb') as handle:
-                cache_path = os.path.realpath(handle.name)
-                logger.info('Save cache at {}'.format(cache_path))
-                pickle.dump(results, handle)
 
-    return results
+def is_cache_synced():
+    """
+    Tell whether the cached certificates are synced before they are used.
+
+    :return: cache_sync of [GENERAL], False if not set
+    """
+    return configuration.config.getboolean('GENERAL', 'cache_sync',
+                                           fallback=False)
+
+
+def get_certificates_high_water(certificates):
+    """
+    Get the filter of the certificates created or changed after the given
+    ones.
+
+    updated_at catches the changed certificates too, id only the new ones.
+
+    :param certificates: certificates with updated_at or id
+    :return: dictionary of a tastypie filter, None if no certificate has
+             them, e.g. cached before they were queried
+    """
+    updated_at = [certificate['updated_at'] for certificate in certificates
+                  if certificate.get('updated_at')]
+    if updated_at:
+        # the ones changed at the same time are merged again, not missed
+        return {'updated_at__gte': max(updated_at)}
+
+    ids = [int(certificate['id']) for certificate in certificates
+           if certificate.get('id') is not None]
+    if ids:
+        return {'id__gt': max(ids)}
+
+    return None
+
+
+def sync_certificates_by_location(location, certificates, filters=None):
+    """
+    Merge the certificates of location created or changed since the given
+    ones into them.
+
+    Only the high-water mark is passed to C3, so a cached certificate
+    changed out of the filters is fetched too. The merged certificates
+    are then filtered locally, which drops it. Certificates are matched
+    by their resource uri. Certificates deleted from C3 or moved to
+    another location are not noticed, so the sync is opt-in by
+    cache_sync.
+
+    :param location: string, e.g. Taipei
+    :param certificates: certificates of the last run
+    :param filters: filters of the certificates, None for no filter
+    :return: list of certificates
+    """
+    high_water = get_certificates_high_water(certificates)
+    if high_water is None:
+        logger.info('Cached certificates of {} cannot be synced, download '
+                    'them again.'.format(location))
+        return c3q.query_certificates_by_location(location, filters)
+
+    logger.info('Sync certificates of {} since {}'.format(location,
+                                                         high_water))
+    merged = collections.OrderedDict(
+        (certificate.get('resource_uri', certificate.get('id')), certificate)
+        for certificate in certificates)
+    changes = 0
+    for certificate in c3q.iter_certificates_by_location(location,
+                                                         high_water):
+        merged[certificate.get('resource_uri',
+                               certificate.get('id'))] = certificate
+        changes += 1
+    logger.info('{} certificates of {} are created or changed.'.format(
+        changes, location))
+
+    return [certificate for certificate in merged.values()
+            if match_filters(certificate, filters)]
+
+
+def match_filters(obj, filters):
+    """
+    Tell whether an object matches tastypie filters.
+
+    Only exact and __in lookups are checked, e.g. release__release or
+    level__in. Other lookups, and fields the object does not carry, are
+    left to C3 and match.
+
+    :param obj: dictionary, e.g. a certificate
+    :param filters: dictionary of tastypie filters, None for no filter
+    :return: True if obj matches every filter
+    """
+    for name, value in (filters or {}).items():
+        keys = name.split('__')
+        lookup = 'exact'
+        if keys[-1] in ('exact', 'in'):
+            lookup = keys.pop()
+        elif len(keys) > 1 and keys[-1] in ('gt', 'gte', 'lt', 'lte',
+                                             'contains', 'startswith'):
+            continue
+
+        field = obj
+        for key in keys:
+            if not isinstance(field, dict) or key not in field:
+                break
+            field = field[key]
+        else:
+            values = str(value).split(',') if lookup == 'in' \
+                else [str(value)]
+            if str(field) not in values:
+                return False
+
+    return True
 
 
 def is_certified(summary, release, level, status):
@@ -119,10 +278,15 @@ def has_same_len(base, target):
 def get_cids_by_query(location, certificate, enablement, status,
                       target_cids=[], disable_flag=True,
                       use_cache=False,
-                      filter_kernel=False):
+                      filter_kernel=False,
+                      failed_cid_list='failed-cids.txt'):
     """
     Get cid objects by c3 query.
 
+    A location or a CID failing to be queried does not abort the query.
+    They are retried after all the others, and the CIDs still failing are
+    written to failed_cid_list to be queried again by --cid-list.
+
     :param location: location string
     :param certificate: certification distro
     :param enablement: enablement status
@@ -131,82 +295,93 @@ def get_cids_by_query(location, certificate, enablement, status,
     :param disable_flag: mutually exculsive option of target_cids
     :param use_cache: if read and write pickle files
     :param filter_kernel: if enable the filter by kernel
+    :param failed_cid_list: where to write the failed CIDs
     :return: cid objects in a list
     """
     # return cid objects
     cids = []
-    try:
-        print('Begin to query... ')
-        summaries_location = []
-        if location == 'all':
-            summaries_not_merge = []
-            # lcts: locations
-            summaries_not_merge_lcts = []
-            for location_entry in c3.maptable.location:
-                summaries_entry = get_certificates_by_location(location_entry,
-                                                               use_cache=use_cache)
-                summaries_not_merge.append(summaries_entry)
-
-                entry_locations = [location_entry] * len(summaries_entry)
-                summaries_not_merge_lcts.append(entry_locations)
-
-            summaries = merge_summaries(summaries_not_merge)
-            summaries_location = merge_summaries(summaries_not_merge_lcts)
-
-            if not has_same_len(summaries, summaries_location):
-                logger.critical("Location flag list length is incorrect.")
-                raise Exception
+    print('Begin to query... ')
+    if location == 'all':
+        locations = list(c3.maptable.location)
+    else:
+        locations = [location]
 
-        else:
-            summaries = get_certificates_by_location(location,
-                                                     use_cache=use_cache)
-            summaries_location = ['location']*len(summaries)
+    # download the matching certificates only, is_certified still checks
+    # them in case C3 ignores the filters
+    filters = {'release__release': certificate,
+               'level': enablement,
+               'status': status}
 
+    def collect(location_entry):
         logger.debug('Get certificate-location result per CIDs')
-        counter_location = 0
+        location_candidates = []
+        summaries = iter_certificates_by_location(location_entry,
+                                                  use_cache=use_cache,
+                                                  filters=filters)
         for summary in summaries:
-            if is_certified(summary, certificate, enablement, status):
-                cid_id = summary['machine'].split('/')[-2]
-
-                if summary['report'] is None:
-                    logger.warning('This certificate has no submission.')
-                else:
-                    if cid_id in target_cids or disable_flag:
-                        print("Fetching data for {}".format(cid_id))
-
-                        submission_id = summary['report'].split('/')[-2]
-                        # TODO: use query_specific_submission instead
-                        # submission_report = c3q.query_submission(submission_id)
-                        cid_obj = c3cid.get_cid_from_submission(submission_id)
-                        cid_obj.__dict__.update(cid=cid_id)
-                        location_index = summaries.index(summary)
-                        cid_location = summaries_location[location_index]
-                        cid_obj.__dict__.update(location=cid_location)
-
-                        if filter_kernel:
-                            logging.info('Enable kernel version filter')
-                            # TODO: a workaround to filter kernel criteria
-                            try:
-                                filter_kernel = \
-                                    configuration.config['FILTER']['kernel']
-                            except KeyError:
-                                filter_kernel = ''
-
-                            filter_keywords = filter_kernel.split('-')
-                            if filter_kernel and \
-                               is_kernel_match_filter(filter_keywords, cid_obj.kernel):
-                                cids.append(cid_obj)
-                            elif filter_kernel:
-                                logger.warning('Skip as a workaround.')
-                            else:
-                                cids.append(cid_obj)
-                        else:
-                            cids.append(cid_obj)
-
-            counter_location += 1
-
-    except QueryError:
-        logger.critical("Problem with C3 Query")
+            if not is_certified(summary, certificate, enablement, status):
+                continue
+
+            cid_id = summary['machine'].split('/')[-2]
+
+            if summary['report'] is None:
+                logger.warning('This certificate has no submission.')
+            elif cid_id in target_cids or disable_flag:
+                submission_id = summary['report'].split('/')[-2]
+                location_candidates.append((cid_id, submission_id,
+                                            location_entry))
+
+        return location_candidates
+
+    # collect the submissions first so they could be fetched concurrently,
+    # a location is collected as a whole or retried later
+    candidates = []
+    location_results = api_instance.api.map_query_deferred(collect, locations,
+                                                           max_workers=1)
+    for location_entry, result in zip(locations, location_results):
+        if isinstance(result, QueryError):
+            logger.critical("Problem with C3 Query of location {}: {}"
+                            .format(location_entry, result))
+            continue
+        candidates.extend(result)
+
+    print("Fetching data for {} CIDs".format(len(candidates)))
+    cid_objs = c3cid.build_cids_from_submissions(
+        [candidate[1] for candidate in candidates])
+
+    failed_cids = []
+    for candidate, cid_obj in zip(candidates, cid_objs):
+        cid_id, submission_id, cid_location = candidate
+        if isinstance(cid_obj, QueryError):
+            logger.warning('Skip {} for failed query.'.format(cid_id))
+            failed_cids.append(cid_id)
+            continue
+
+        cid_obj.__dict__.update(cid=cid_id)
+        cid_obj.__dict__.update(location=cid_location)
+
+        if filter_kernel:
+            logging.info('Enable kernel version filter')
+            # TODO: a workaround to filter kernel criteria
+            try:
+                filter_kernel = \
+                    configuration.config['FILTER']['kernel']
+            except KeyError:
+                filter_kernel = ''
+
+            filter_keywords = filter_kernel.split('-')
+            if filter_kernel and \
+               is_kernel_match_filter(filter_keywords, cid_obj.kernel):
+                cids.append(cid_obj)
+            elif filter_kernel:
+                logger.warning('Skip as a workaround.')
+            else:
+                cids.append(cid_obj)
+        else:
+            cids.append(cid_obj)
+
+    if failed_cids and failed_cid_list:
+        c3cid_list.write_cid_list(failed_cids, failed_cid_list)
 
     return cids
 
@@ -0,0 +1,122 @@
+"""
+Registry of the request policy of each C3 endpoint.
+
+Each endpoint name, e.g. hardware, maps to a profile of connect and read
+timeouts, retry budget, cache ttl and concurrency cap. The built-in
+profiles could be overridden in the [API] section of the configuration
+file by keys in the form of <endpoint>.<field>, for example:
+
+    hardware.timeout = 5, 30
+    hardware.retries = 10
+    hardware.ttl = 300
+    hardware.concurrency = 8
+"""
+import logging
+
+
+logger = logging.getLogger('c3_web_query')
+
+# fields not listed here fall back to the registry defaults
+default_profiles = {
+    # holder, location and status change
+    'hardware': {'cache_ttl': 300},
+    # reports and their devices never change once submitted
+    'machineReport': {'read_timeout': 60, 'cache_ttl': -1},
+    'reportFind': {'cache_ttl': -1},
+    'report_devices': {'cache_ttl': -1},
+    'reportDevices': {'cache_ttl': -1},
+    'reportLatest': {},
+    # certificates by location
+    'location': {'read_timeout': 60},
+    'locations': {'cache_ttl': -1},
+}
+
+
+class EndpointProfile(object):
+
+    def __init__(self, name, connect_timeout=30.0, read_timeout=30.0,
+                 max_retries=10, cache_ttl=0, concurrency=0):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        # seconds to cache the responses, negative for ever, 0 no cache
+        self.cache_ttl = cache_ttl
+        # requests in flight to the endpoint, 0 for no cap
+        self.concurrency = concurrency
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+
+class EndpointRegistry(object):
+    """
+    Look up the profile of an endpoint by its name, case insensitive.
+
+    Unknown endpoints and fields use timeout and max_retries.
+    """
+
+    def __init__(self, timeout=30.0, max_retries=10, profiles=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.profiles = {}
+
+        overrides = {}
+        for source in (default_profiles, profiles or {}):
+            for name, fields in source.items():
+                overrides.setdefault(name.lower(), {}).update(fields)
+        for name, fields in overrides.items():
+            self.profiles[name] = self._new_profile(name, **fields)
+
+    def _new_profile(self, name, **fields):
+        profile = EndpointProfile(name,
+                                  connect_timeout=self.timeout,
+                                  read_timeout=self.timeout,
+                                  max_retries=self.max_retries)
+        profile.__dict__.update(fields)
+
+        return profile
+
+    def get(self, name):
+        """
+        :param name: endpoint name, e.g. hardware. None for unknown.
+        :return: EndpointProfile
+        """
+        key = str(name).lower()
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles.setdefault(key, self._new_profile(name))
+
+        return profile
+
+    @classmethod
+    def from_config(cls, section, timeout=30.0, max_retries=10):
+        """
+        Build the registry from the [API] section of the configuration.
+
+        :param section: configparser section, None for built-in profiles
+        :return: EndpointRegistry
+        """
+        profiles = {}
+        for key in (section or {}):
+            if '.' not in key:
+                # endpoint paths
+                continue
+            name, field = key.rsplit('.', 1)
+            fields = profiles.setdefault(name, {})
+            value = section[key]
+            if field == 'timeout':
+                timeouts = [float(item) for item in value.split(',')]
+                fields['connect_timeout'] = timeouts[0]
+                fields['read_timeout'] = timeouts[-1]
+            elif field == 'retries':
+                fields['max_retries'] = int(value)
+            elif field == 'ttl':
+                fields['cache_ttl'] = float(value)
+            elif field == 'concurrency':
+                fields['concurrency'] = int(value)
+            else:
+                logger.warning('Unknown endpoint policy {}'.format(key))
+
+        return cls(timeout, max_retries, profiles)
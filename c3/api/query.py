@@ -4,9 +4,11 @@ All api real query action will be collected here.
 import c3.config
 import c3.maptable
 import c3.api.api as c3api
-import requests
 import logging
 import json
+import collections
+from c3.api.api_utils import QueryError
+from c3.maptable import machine_metainfo_attr as mma
 
 logger = logging.getLogger('c3_web_query')
 format_str = "[ %(funcName)s() ] %(message)s"
@@ -21,11 +23,201 @@ def query_over_api_hardware(cid):
     c3url = conf_instance.config['C3']['URI']
     hardware_api = conf_instance.config['API']['hardware']
     result = api_instance.api.single_query(c3url + hardware_api + cid,
-                                           params=api_instance.request_params)
+                                           params=api_instance.request_params,
+                                           endpoint='hardware')
 
     return result
 
 
+def query_over_api_hardwares(cids):
+    """
+    Query the hardware api of many CIDs.
+
+    :param cids: CIDs, list of string
+    :return: list of results in the order of cids, QueryError if failed
+    """
+    hardwares = query_hardware_bulk(cids)
+
+    return [hardwares[cid] for cid in cids]
+
+
+def query_hardware_bulk(cids, chunk=100):
+    """
+    Query the hardware of many CIDs by the list endpoint.
+
+    The CIDs are filtered by canonical_id__in, chunk CIDs per request.
+    See query_in_chunks.
+
+    :param cids: CIDs, list of string
+    :param chunk: CIDs per request
+    :return: dictionary of hardware keyed by CID, QueryError for the CIDs
+             failed or not found
+    """
+    c3url = configuration.config['C3']['URI']
+    hardware_api = configuration.config['API']['hardware']
+
+    found = query_in_chunks(c3url + hardware_api, 'canonical_id', cids,
+                            endpoint='hardware',
+                            fallback=query_over_api_hardware, chunk=chunk)
+
+    hardwares = {}
+    for cid in cids:
+        hardwares[cid] = found.get(cid) or QueryError(
+            '{} is not found'.format(cid), 404)
+
+    return hardwares
+
+
+def query_in_chunks(api_uri, key_field, keys, endpoint, fallback=None,
+                    chunk=100, fields=None):
+    """
+    Query the objects of many keys by a list endpoint and its __in filter.
+
+    The keys are filtered by <key_field>__in, chunk keys per request, and
+    the chunks are queried concurrently. A failed chunk is retried after
+    the others. If C3 rejects the filter, the keys of the chunk are
+    queried one by one by fallback instead.
+
+    :param api_uri: url of the list endpoint
+    :param key_field: field to filter and to key the objects, e.g. id
+    :param keys: list of string
+    :param endpoint: endpoint name of the list endpoint
+    :param fallback: callable taking one key and returning its object,
+                     None to fail the chunk
+    :param chunk: keys per request
+    :param fields: fields to keep in each object, None to keep all
+    :return: dictionary of objects keyed by the string of their key,
+             QueryError for the keys of failed chunks, keys not found are
+             absent
+    """
+    # drop duplicates but keep the order
+    keys = list(collections.OrderedDict.fromkeys(str(key) for key in keys))
+    chunks = [keys[index:index + chunk]
+              for index in range(0, len(keys), chunk)]
+    if fields is not None and key_field not in fields:
+        fields = list(fields) + [key_field]
+
+    def query_chunk(chunk_keys):
+        params = dict(api_instance.request_params, limit=len(chunk_keys))
+        params[key_field + '__in'] = ','.join(chunk_keys)
+        page = api_instance.api.single_query(api_uri, params=params,
+                                             endpoint=endpoint, fields=fields)
+        objects = list(page['objects'])
+        c3url = configuration.config['C3']['URI']
+        while page['meta'].get('next'):
+            page = api_instance.api.single_query(c3url + page['meta']['next'],
+                                                 endpoint=endpoint,
+                                                 fields=fields)
+            objects.extend(page['objects'])
+
+        return objects
+
+    results = api_instance.api.map_query_deferred(query_chunk, chunks)
+
+    found = {}
+    for chunk_keys, result in zip(chunks, results):
+        if isinstance(result, QueryError) and result.status_code == 400 \
+           and fallback is not None:
+            logger.warning('Filter {}__in is rejected, query the keys one by '
+                           'one.'.format(key_field))
+            for key, obj in zip(chunk_keys, api_instance.api.map_query(
+                    fallback, chunk_keys)):
+                found[key] = obj
+        elif isinstance(result, QueryError):
+            for key in chunk_keys:
+                found[key] = result
+        else:
+            for obj in result:
+                found[str(obj[key_field])] = obj
+
+    return found
+
+
+def query_machine_reports_bulk(submission_ids, chunk=100):
+    """
+    Get machine reports of many submissions, chunk reports per request.
+
+    See query_in_chunks.
+
+    :param submission_ids: submission / machine report ids, list of string
+    :param chunk: reports per request
+    :return: dictionary of machine reports keyed by submission id, None
+             for reports not found, QueryError for the failed ones
+    """
+    c3url = configuration.config['C3']['URI']
+    report_api = configuration.config['API']['reportFind']
+
+    found = query_in_chunks(c3url + report_api, 'id', submission_ids,
+                            endpoint='reportFind',
+                            fallback=query_specific_machine_report,
+                            chunk=chunk, fields=mma)
+
+    return dict((submission_id, found.get(str(submission_id)))
+                for submission_id in submission_ids)
+
+
+def iter_submission_devices_bulk(submission_ids, chunk=50):
+    """
+    Get the devices of many submissions and yield them by submission.
+
+    The device rows of chunk submissions are queried by one paginated
+    query of the reportDevices list endpoint filtered by report__in, and
+    grouped by their report as the pages stream in. Only the rows of one
+    chunk are held in memory at a time.
+
+    Without reportDevices in [API], or if C3 rejects the filter, the
+    devices are queried submission by submission instead. So are the
+    devices of a chunk whose query fails.
+
+    :param submission_ids: submission ids, list of string
+    :param chunk: submissions per query
+    :return: generator of (submission id, devices), QueryError instead of
+             the devices of the failed submissions
+    """
+    c3url = configuration.config['C3']['URI']
+    devices_api = configuration.config['API'].get('reportDevices')
+    submission_ids = list(collections.OrderedDict.fromkeys(
+        str(submission_id) for submission_id in submission_ids))
+    fields = c3.maptable.device_fields + ['report']
+
+    for index in range(0, len(submission_ids), chunk):
+        chunk_ids = submission_ids[index:index + chunk]
+        devices = None
+        if devices_api:
+            params = dict(api_instance.request_params,
+                          report__in=','.join(chunk_ids), order_by='report')
+            devices = collections.OrderedDict((submission_id, [])
+                                              for submission_id in chunk_ids)
+            try:
+                for row in api_instance.api.iter_batch_query(
+                        c3url + devices_api, params=params,
+                        endpoint='reportDevices', fields=fields):
+                    report = row.pop('report')
+                    if isinstance(report, str):
+                        # resource uri, e.g. /api/v1/machinereports/12/
+                        report = report.rstrip('/').split('/')[-1]
+                    devices.setdefault(str(report), []).append(row)
+            except QueryError as excp:
+                if excp.status_code == 400:
+                    logger.warning('Filter report__in is rejected, query '
+                                   'the devices submission by submission.')
+                    devices_api = None
+                else:
+                    logger.warning('Query the devices of the chunk '
+                                   'submission by submission: {}'
+                                   .format(excp))
+                devices = None
+
+        if devices is None:
+            devices = zip(chunk_ids, api_instance.api.map_query_deferred(
+                query_submission_devices, chunk_ids))
+        else:
+            devices = devices.items()
+
+        for submission_id, submission_devices in devices:
+            yield submission_id, submission_devices
+
+
 def push_over_api_hardware(cid, data, header=None):
     if not header:
         header = {"Content-Type": "application/json"}
@@ -36,10 +228,11 @@ def push_over_api_hardware(cid, data, header=None):
     hardware_api = conf_instance.config['API']['hardware']
     api_url = c3url + hardware_api + cid + "/"
 
-    response = requests.patch(api_url,
-                              params=api_instance.request_params,
-                              data=data,
-                              headers=header)
+    response = api_instance.api.push(api_url,
+                                     params=api_instance.request_params,
+                                     data=data,
+                                     headers=header,
+                                     endpoint='hardware')
 
     return response
 
@@ -68,17 +261,52 @@ def query_location_vendor(cid):
     return info_location, info_vendor
 
 
-def query_certificates_by_location(location='Taipei'):
+def query_certificates_by_location(location='Taipei', filters=None):
+    return list(iter_certificates_by_location(location, filters))
+
+
+def iter_certificates_by_location(location='Taipei', filters=None):
+    """
+    Get certificates by location page by page.
+
+    filters are passed to C3 so only the matching certificates are
+    downloaded, e.g. {'release__release': '16.04 LTS', 'level': 'Enabled',
+    'status': 'Complete - Pass'}. If C3 rejects them, every certificate
+    of the location is downloaded instead, so the callers should still
+    filter the certificates on their own.
+
+    :param location: string, e.g. Taipei
+    :param filters: dictionary of tastypie filters, None for no filter
+    :return: generator of certificates
+    """
     print("Get certificates by the specified location: %s" % location)
-    print('This will take around 3 minutes. Please be patient...')
 
     c3url = configuration.config['C3']['URI']
     api_location = get_location_api_by_location(location)
+    params = dict(api_instance.request_params, **(filters or {}))
+
+    if not filters:
+        print('This will take around 3 minutes. Please be patient...')
+
+    yielded = False
+    try:
+        for certificate in api_instance.api.iter_batch_query(
+                c3url + api_location, params=params, endpoint='location',
+                fields=c3.maptable.certificate_fields):
+            yielded = True
+            yield certificate
+        return
+    except QueryError as excp:
+        if not filters or yielded or excp.status_code != 400:
+            raise
+        logger.warning('Certificate filters are rejected, filter the '
+                       'certificates of {} locally.'.format(location))
 
-    results = api_instance.api.batch_query(c3url + api_location,
-                                           params=api_instance.request_params)
-
-    return results
+    print('This will take around 3 minutes. Please be patient...')
+    for certificate in api_instance.api.iter_batch_query(
+            c3url + api_location, params=api_instance.request_params,
+            endpoint='location', fields=c3.maptable.certificate_fields):
+        yield certificate
 
 
 def query_submission_devices(submission):
@@ -92,17 +320,13 @@ def query_submission_devices(submission):
     api_endpoint = configuration.config['API']['machineReport'] + \
                    submission + '/report_devices/'
     api_uri = c3url + api_endpoint
-    # rp = api_instance.request_params
-    # apiq = APIQuery(c3url)
-    # machine_report = apiq.single_query(api_uri, params=rp)
-    # TODO: not sure APIQuery does not work. Use request here instead.
     rp = {'username': configuration.config['C3']['UserName'],
           'api_key': configuration.config['C3']['APIKey'],
           'limit': configuration.config['C3']['BatchQueryMode']}
 
-    response = requests.get(api_uri, params=rp)
-
-    device_report = response.json()
+    device_report = api_instance.api.single_query(
+        api_uri, params=rp, endpoint='report_devices',
+        fields=c3.maptable.device_fields)
 
     return device_report['objects']
 
@@ -133,8 +357,9 @@ def query_submission(submission_id):
     # response = requests.get(api_uri, params=rp)
     #
     # return response.json()
-    report = api_instance.api.single_query(api_uri, timeout=60,
-                                           params=rp)
+    # the read timeout is in the machineReport profile
+    report = api_instance.api.single_query(api_uri, params=rp,
+                                           endpoint='machineReport')
 
     return report
 
@@ -162,7 +387,9 @@ def query_specific_machine_report(m_id):
     report_api = configuration.config['API']['reportFind']
 
     report = api_instance.api.single_query(c3url + report_api,
-                                           params=req_params)
+                                           params=req_params,
+                                           endpoint='reportFind',
+                                           fields=mma)
 
     if not len(report['objects']) == 1:
         print('Something wrong with the number.')
@@ -193,8 +420,11 @@ def query_latest_machine_report(cid):
                   "limit": "1",
                   "order_by": "-created_at"}
 
+    # the latest report changes, do not share the cache policy of
+    # reportFind which looks up immutable reports by id
     report = api_instance.api.single_query(c3url + report_api,
-                                           params=req_params)
+                                           params=req_params,
+                                           endpoint='reportLatest')
 
     if len(report['objects']) == 0:
         machine_report = None
@@ -265,6 +495,29 @@ def parse_platform_name(result):
 def query_holder_location(cid):
     result = query_over_api_hardware(cid)
 
+    return parse_holder_location(result)
+
+
+def query_holder_locations(cids):
+    """
+    Get holder, location, status and platform name of many CIDs concurrently.
+
+    :param cids: CIDs, list of string
+    :return: list of tuples in the order of cids, QueryError if failed
+    """
+    results = query_over_api_hardwares(cids)
+
+    rtn = []
+    for result in results:
+        if isinstance(result, QueryError):
+            rtn.append(result)
+        else:
+            rtn.append(parse_holder_location(result))
+
+    return rtn
+
+
+def parse_holder_location(result):
     holder = parse_holder(result)
     location = parse_location(result)
     status = parse_status(result)
@@ -0,0 +1,226 @@
+"""
+Accounting of the C3 requests.
+"""
+import math
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger('c3_web_query')
+
+
+class TransferStats(object):
+    """
+    Bytes moved per endpoint, both on the wire and after decompression.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = collections.Counter()
+        self.wire_bytes = collections.Counter()
+        self.body_bytes = collections.Counter()
+
+    def record(self, endpoint, response):
+        body_bytes = len(response.content)
+        wire_bytes = get_wire_bytes(response, body_bytes)
+        with self.lock:
+            self.responses[endpoint] += 1
+            self.wire_bytes[endpoint] += wire_bytes
+            self.body_bytes[endpoint] += body_bytes
+
+    def summary(self):
+        """
+        :return: list of (endpoint, responses, wire bytes, body bytes)
+        """
+        with self.lock:
+            return [(endpoint, self.responses[endpoint],
+                     self.wire_bytes[endpoint], self.body_bytes[endpoint])
+                    for endpoint in sorted(self.responses, key=str)]
+
+    def log_summary(self, level=logging.DEBUG):
+        for endpoint, responses, wire_bytes, body_bytes in self.summary():
+            ratio = wire_bytes / body_bytes if body_bytes else 1.0
+            logger.log(level,
+                       '{}: {} responses, {} bytes on the wire, {} bytes '
+                       'decompressed ({:.0%})'.format(endpoint, responses,
+                                                      wire_bytes, body_bytes,
+                                                      ratio))
+
+
+def get_wire_bytes(response, body_bytes):
+    """
+    Get how many bytes of the response body went over the wire.
+
+    urllib3 counts the bytes it reads before decompressing them. Fall back
+    to Content-Length, then to the decompressed size, e.g. for responses
+    not coming from urllib3.
+
+    :param response: response whose content has been read
+    :param body_bytes: size of the decompressed body
+    :return: int
+    """
+    raw = getattr(response, 'raw', None)
+    if raw is not None and hasattr(raw, 'tell'):
+        try:
+            return raw.tell()
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return body_bytes
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style histogram of latencies.
+
+    Every doubling of the latency from unit seconds is split into
+    sub_buckets buckets of equal width, so a percentile is off by at most
+    1 / sub_buckets of its value whatever its magnitude, and the memory is
+    bounded by the range of the latencies instead of their count.
+    """
+
+    def __init__(self, unit=0.0001, sub_buckets=16):
+        self.unit = unit
+        self.sub_buckets = sub_buckets
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, latency):
+        if latency < self.unit:
+            return 0
+        mantissa, exponent = math.frexp(latency / self.unit)
+
+        return exponent * self.sub_buckets + \
+            int((mantissa - 0.5) * 2 * self.sub_buckets)
+
+    def upper_bound(self, index):
+        """
+        :return: seconds, the largest latency of bucket index
+        """
+        if index == 0:
+            return self.unit
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+
+        return self.unit * 2 ** (exponent - 1) * \
+            (1 + (sub_bucket + 1) / float(self.sub_buckets))
+
+    def add(self, latency):
+        self.counts[self._index(latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        """
+        :param percent: e.g. 99 for p99
+        :return: seconds, None if there is no latency yet
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), self.max)
+
+        return self.max
+
+    def buckets(self):
+        """
+        :return: list of (upper bound in seconds, count) of non-empty
+                 buckets
+        """
+        return [(self.upper_bound(index), self.counts[index])
+                for index in sorted(self.counts)]
+
+
+class RequestStats(TransferStats):
+    """
+    Requests, retries, status codes, bytes and latencies per endpoint.
+
+    A request which got no response at all is counted with the status
+    code 'error'.
+    """
+
+    def __init__(self):
+        super(RequestStats, self).__init__()
+        self.requests = collections.Counter()
+        self.retries = collections.Counter()
+        self.status_codes = collections.defaultdict(collections.Counter)
+        self.histograms = collections.defaultdict(LatencyHistogram)
+
+    def record_request(self, endpoint, response, latency):
+        """
+        :param endpoint: endpoint name
+        :param response: response, None if it was not received
+        :param latency: seconds the request took
+        """
+        if response is not None:
+            self.record(endpoint, response)
+        with self.lock:
+            self.requests[endpoint] += 1
+            status_code = 'error' if response is None \
+                else response.status_code
+            self.status_codes[endpoint][status_code] += 1
+            self.histograms[endpoint].add(latency)
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self.retries[endpoint] += 1
+
+    def report(self):
+        """
+        :return: dictionary of the stats of each endpoint, ready for json
+        """
+        report = {}
+        with self.lock:
+            for endpoint in sorted(self.requests, key=str):
+                histogram = self.histograms[endpoint]
+                latency = dict(('p{}'.format(percent),
+                                histogram.percentile(percent))
+                               for percent in (50, 90, 99))
+                latency.update(
+                    mean=histogram.total / histogram.count,
+                    max=histogram.max,
+                    total=histogram.total,
+                    buckets=histogram.buckets())
+                report[str(endpoint)] = {
+                    'requests': self.requests[endpoint],
+                    'retries': self.retries[endpoint],
+                    'status_codes': dict(
+                        (str(code), count) for code, count
+                        in self.status_codes[endpoint].items()),
+                    'wire_bytes': self.wire_bytes[endpoint],
+                    'body_bytes': self.body_bytes[endpoint],
+                    'latency': latency}
+
+        return report
+
+    def format_report(self):
+        """
+        :return: the report as a table, one row per endpoint
+        """
+        row = '{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>12}  {}'
+        lines = [row.format('endpoint', 'requests', 'retries', 'total(s)',
+                            'p50(ms)', 'p90(ms)', 'p99(ms)', 'wire bytes',
+                            'status codes')]
+        for endpoint, stats in self.report().items():
+            latency = stats['latency']
+            lines.append(row.format(
+                endpoint, stats['requests'], stats['retries'],
+                '{:.1f}'.format(latency['total']),
+                '{:.0f}'.format(latency['p50'] * 1000),
+                '{:.0f}'.format(latency['p90'] * 1000),
+                '{:.0f}'.format(latency['p99'] * 1000),
+                stats['wire_bytes'],
+                ' '.join('{}:{}'.format(code, count) for code, count
+                         in sorted(stats['status_codes'].items()))))
+
+        return '\n'.join(lines)
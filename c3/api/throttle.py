@@ -0,0 +1,263 @@
+"""
+Client-side throttling of C3 requests.
+"""
+import time
+import heapq
+import random
+import itertools
+import logging
+import threading
+import collections
+import email.utils
+
+
+logger = logging.getLogger('c3_web_query')
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter shared by all the threads of a process.
+
+    rate tokens are added every second up to burst tokens. Every request
+    takes one token and waits until the token is available. A rate of 0
+    disables the limiter.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # reserve the token now and wait for it outside of the lock,
+            # tokens going negative queue the callers in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def backoff_delay(tries, base=0.5, cap=30.0):
+    """
+    Exponential backoff with full jitter.
+
+    :param tries: how many times the request has been tried, from 1
+    :param base: seconds of the first backoff
+    :param cap: maximum seconds to wait
+    :return: seconds to wait before the next try
+    """
+    return random.uniform(0, min(cap, base * 2 ** (tries - 1)))
+
+
+def retry_after_delay(response):
+    """
+    Get the seconds to wait told by the Retry-After header of response.
+
+    :param response: response of the request
+    :return: seconds, None if the header is absent or invalid
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# priority classes of requests
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# share of the free slots each priority class gets when both are waiting
+priority_weights = {INTERACTIVE: 8, BULK: 1}
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limit how many requests are in flight at the same time.
+
+    Requests waiting for a slot are queued by weighted fair queuing over
+    their priority classes: every waiter is tagged with a virtual finish
+    time, which grows by 1 / weight of its class, and the free slot goes
+    to the smallest tag. Interactive requests therefore overtake queued
+    bulk requests, while bulk requests still get 1 / 9 of the slots and
+    never starve.
+
+    A limit of None means no limit.
+    """
+
+    def __init__(self, limit=None, weights=None):
+        self.limit = limit
+        self.weights = dict(weights or priority_weights)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.last_finish = {}
+
+    @property
+    def window(self):
+        return self.limit
+
+    def acquire(self, priority=INTERACTIVE):
+        """
+        Wait for a slot.
+
+        :param priority: INTERACTIVE or BULK
+        """
+        with self.condition:
+            if not self.waiters and self._has_slot():
+                self.in_flight += 1
+                return
+
+            weight = self.weights.get(priority, 1)
+            finish = max(self.virtual_time,
+                         self.last_finish.get(priority, 0.0)) + 1.0 / weight
+            self.last_finish[priority] = finish
+            ticket = (finish, next(self.sequence))
+            heapq.heappush(self.waiters, ticket)
+            while self.waiters[0] != ticket or not self._has_slot():
+                self.condition.wait()
+            heapq.heappop(self.waiters)
+            self.virtual_time = finish
+            self.in_flight += 1
+            # the next waiter may have a slot too
+            self.condition.notify_all()
+
+    def _has_slot(self):
+        return self.window is None or self.in_flight < self.window
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, started_at, latency, failed):
+        """
+        Learn from a finished request. The fixed limiter does nothing.
+
+        :param started_at: time.monotonic() when the request was sent
+        :param latency: seconds the request took
+        :param failed: True for timeouts, connection failures and 5xx
+        """
+        pass
+
+
+class AIMDController(ConcurrencyLimiter):
+    """
+    Adjust the in-flight window by additive increase, multiplicative decrease.
+
+    After every round, i.e. as many finished requests as the window, the
+    window grows by one if the p95 latency of the recent requests is
+    within latency_tolerance times the best p95 seen so far and the error
+    rate is below max_error_rate. A failed request halves the window at
+    once, but only once for all the requests sent before the last cut.
+    """
+
+    def __init__(self, max_window, min_window=1, sample_size=100,
+                 latency_tolerance=2.0, max_error_rate=0.05,
+                 decrease_factor=0.5):
+        super(AIMDController, self).__init__()
+        self.max_window = max(min_window, max_window)
+        self.min_window = min_window
+        self.current_window = float(min_window)
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.decrease_factor = decrease_factor
+        self.latencies = LatencyWindow(sample_size)
+        self.errors = collections.deque(maxlen=sample_size)
+        self.best_p95 = None
+        self.round_count = 0
+        self.decreased_at = 0.0
+
+    @property
+    def window(self):
+        return int(self.current_window)
+
+    def record(self, started_at, latency, failed):
+        with self.condition:
+            self.errors.append(failed)
+            if failed:
+                if started_at >= self.decreased_at:
+                    self._set_window(self.current_window *
+                                     self.decrease_factor)
+                    self.decreased_at = time.monotonic()
+                    self.round_count = 0
+                return
+
+            self.latencies.add(latency)
+            self.round_count += 1
+            if self.round_count < self.window:
+                return
+            self.round_count = 0
+
+            p95 = self.latencies.percentile(95)
+            if self.best_p95 is None or p95 < self.best_p95:
+                self.best_p95 = p95
+            error_rate = sum(self.errors) / len(self.errors)
+            if p95 <= self.best_p95 * self.latency_tolerance and \
+               error_rate <= self.max_error_rate:
+                self._set_window(self.current_window + 1)
+
+    def _set_window(self, window):
+        window = max(self.min_window, min(self.max_window, window))
+        if int(window) != self.window:
+            logger.debug('Concurrency window: {} -> {}'.format(self.window,
+                                                               int(window)))
+        self.current_window = window
+        self.condition.notify_all()
+
+
+class LatencyWindow(object):
+    """
+    The latencies of the most recent requests.
+    """
+
+    def __init__(self, size=100):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, percent):
+        """
+        :param percent: e.g. 95 for p95
+        :return: seconds, None if there is no sample yet
+        """
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+
+        return samples[index]
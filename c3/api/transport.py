@@ -0,0 +1,59 @@
+"""
+The HTTP transport shared by every C3 read and write.
+"""
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+import c3.api.cassette as c3cassette
+
+
+logger = logging.getLogger('c3_web_query')
+
+# brotli is decoded only if urllib3 finds brotli or brotlicffi installed
+if 'br' in ACCEPT_ENCODING:
+    accept_encoding = 'gzip, br'
+else:
+    accept_encoding = 'gzip'
+
+
+class Transport(object):
+    """
+    One pooled keep-alive session for all requests to C3.
+
+    The connection pool is sized to the number of concurrent requests so
+    that every worker could reuse a connection instead of opening a new
+    TCP and TLS connection per request. Every request asks for compressed
+    responses.
+    """
+
+    def __init__(self, pool_size=10, timeout=30.0):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.session()
+        self.session.headers['Accept-Encoding'] = accept_encoding
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def record(self, directory):
+        """
+        Record every response to the cassette in directory.
+        """
+        self.session = c3cassette.CassetteRecorder(self.session, directory)
+
+    def replay(self, directory, latency=False):
+        """
+        Serve every request from the cassette in directory, without network.
+
+        :param latency: delay every response by its recorded latency
+        """
+        self.session = c3cassette.CassettePlayer(directory, latency)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        logger.debug('{} {}'.format(method, url))
+
+        return self.session.request(method, url, **kwargs)
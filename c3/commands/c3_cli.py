@@ -1,10 +1,13 @@
 import os
+import json
 import click
 import logging
 import pkg_resources
 import c3.config as c3config
 import c3.api.api as c3api
 from c3.api.api_utils import APIQuery
+from c3.io.response_cache import ResponseCache
+from c3.api.endpoints import EndpointRegistry
 from c3.commands.pool import commands as group_batch
 from c3.commands.single import commands as group_single
 from c3.commands.query import commands as group_query
@@ -34,7 +37,48 @@ template = pkg_resources.resource_stream(resource_package, resource_path)
               help='Verbose level corresponding to logging level.')
 @click.option('--conf',
               help='Configuration file.')
-def main(c3username, c3apikey, verbose, conf):
+@click.option('--jobs',
+              type=click.IntRange(min=1),
+              default=1,
+              help='Number of C3 requests to run concurrently.')
+@click.option('--page-window',
+              type=click.IntRange(min=1),
+              help='Number of pages of a paginated query to fetch at the '
+                   'same time. Default to --jobs.')
+@click.option('--adaptive/--no-adaptive',
+              default=False,
+              help='Adjust the number of requests in flight to the C3 '
+                   'response time and errors, up to --jobs.')
+@click.option('--http-cache/--no-http-cache',
+              default=True,
+              help='Keep C3 responses in the cache of the [CACHE] section.')
+@click.option('--hedge/--no-hedge',
+              default=False,
+              help='Send a slow GET again after the p95 latency of its '
+                   'endpoint and use whichever answers first.')
+@click.option('--record',
+              type=click.Path(file_okay=False),
+              help='Record every C3 response to a cassette in this '
+                   'directory.')
+@click.option('--replay',
+              type=click.Path(exists=True, file_okay=False),
+              help='Serve every C3 request from the cassette in this '
+                   'directory instead of C3.')
+@click.option('--replay-latency/--no-replay-latency',
+              default=False,
+              help='Delay every replayed response by its recorded latency.')
+@click.option('--stats/--no-stats',
+              default=False,
+              help='Show the requests, retries, status codes, bytes and '
+                   'latencies of each C3 endpoint at the end.')
+@click.option('--stats-json',
+              type=click.Path(dir_okay=False),
+              help='Write the C3 request stats to this json file at the '
+                   'end.')
+@click.pass_context
+def main(ctx, c3username, c3apikey, verbose, conf, jobs, page_window,
+         adaptive, http_cache, hedge, record, replay, replay_latency, stats,
+         stats_json):
     # Pass the global options and configuration by the configuration singlet.
     # configuration singlet initialization
     configuration = c3config.Configuration.get_instance()
@@ -56,13 +100,69 @@ def main(c3username, c3apikey, verbose, conf):
         c3apikey = configuration.config['C3']['APIKey']
 
     c3url = configuration.config['C3']['URI']
-    api = APIQuery(c3url)
+    c3section = configuration.config['C3']
+
+    if record and replay:
+        raise click.UsageError('--record and --replay are mutually '
+                               'exclusive.')
+    if record or replay:
+        # a cassette has to see every request
+        logger.debug('Disable the response cache to record or replay.')
+        http_cache = False
+
+    response_cache = get_response_cache(configuration.config, http_cache)
+
+    timeout = c3section.getfloat('Timeout', 30.0)
+    max_retries = c3section.getint('MaxRetries', 10)
+    api_section = None
+    if configuration.config.has_section('API'):
+        api_section = configuration.config['API']
+    endpoints = EndpointRegistry.from_config(api_section, timeout,
+                                             max_retries)
+
+    max_in_flight = c3section.getint('MaxInFlight')
+    if max_in_flight is None:
+        # --jobs requests, or pages, in flight plus room for their hedges,
+        # so the waiting lookups could be served ahead of the bulk queries
+        max_in_flight = max(jobs, page_window or jobs)
+        if hedge:
+            max_in_flight *= 2
+
+    api = APIQuery(c3url,
+                   timeout=timeout,
+                   max_retries=max_retries,
+                   max_workers=jobs,
+                   page_window=page_window,
+                   pool_size=c3section.getint('PoolSize'),
+                   rate_limit=c3section.getfloat('RateLimit', 0),
+                   rate_burst=c3section.getfloat('RateBurst'),
+                   backoff_base=c3section.getfloat('BackoffBase', 0.5),
+                   backoff_max=c3section.getfloat('BackoffMax', 30.0),
+                   adaptive=adaptive,
+                   response_cache=response_cache,
+                   endpoints=endpoints,
+                   hedge=hedge,
+                   hedge_ratio=c3section.getfloat('HedgeRatio', 0.05),
+                   breaker_threshold=c3section.getint('BreakerThreshold', 5),
+                   breaker_cooldown=c3section.getfloat('BreakerCooldown',
+                                                       60.0),
+                   max_in_flight=max_in_flight,
+                   checkpoint_max_age=c3section.getfloat('CheckpointMaxAge',
+                                                         86400.0))
+
+    if record:
+        api.transport.record(record)
+    elif replay:
+        api.transport.replay(replay, latency=replay_latency)
 
     request_params = {"username": c3username,
                       "api_key": c3apikey}
 
     api_instance = c3api.API.get_instance()
     api_instance.set_api_params(api, request_params)
+    ctx.call_on_close(api.stats.log_summary)
+    if stats or stats_json:
+        ctx.call_on_close(lambda: report_stats(api.stats, stats, stats_json))
 
     try:
         verbose = configuration.config['GENERAL']['Verbose']
@@ -74,6 +174,45 @@ def main(c3username, c3apikey, verbose, conf):
     logging.debug('C3 username: %s' % c3username)
     logging.debug('C3 API KEY: %s' % c3apikey)
     logging.debug('Output verbose level: %s' % verbose)
+    logging.debug('Concurrent jobs: %s' % jobs)
+
+
+def get_response_cache(config, http_cache=True):
+    """
+    Open the response cache at path of [CACHE].
+
+    A user conf replaces default.ini and usually has no [CACHE], so the
+    cache falls back to c3-response-cache.sqlite in that case.
+
+    :param config: configparser of the configuration
+    :param http_cache: False to disable the response cache
+    :return: ResponseCache, None if disabled
+    """
+    if not http_cache:
+        return None
+
+    cache_path = config.get('CACHE', 'path',
+                            fallback='c3-response-cache.sqlite')
+    logger.debug('Use response cache %s' % cache_path)
+
+    return ResponseCache(cache_path)
+
+
+def report_stats(request_stats, show, json_file):
+    """
+    Show or dump the request stats of the finished command.
+
+    :param request_stats: RequestStats of the APIQuery
+    :param show: print the stats as a table to stderr
+    :param json_file: json file to write the stats, None to skip
+    """
+    if show:
+        click.echo(request_stats.format_report(), err=True)
+    if json_file:
+        with open(json_file, 'w') as handle:
+            json.dump(request_stats.report(), handle, indent=2,
+                      sort_keys=True)
+        logger.info('Request stats are written to %s' % json_file)
 
 
 main.add_command(group_batch.create)
@@ -1,6 +1,5 @@
 import click
 import csv
-import time
 import logging
 import c3.api.gdoc as c3gdoc
 import c3.api.query as c3query
@@ -55,21 +54,21 @@ def google_doc(doc_type, doc_id,
         cids.append(cid)
 
     target_data_c3 = []
-    sleep_counter = 0
-    for cid in cids:
+    print('Fetching {} CIDs from c3'.format(len(cids)))
+    results = c3query.query_holder_locations(cids)
+    for cid, result in zip(cids, results):
         print('Fetching {} from c3'.format(cid))
-        try:
-            holder, location = c3query.query_holder_location(cid)
-        except c3api.QueryError:
+        if not isinstance(result, c3api.QueryError):
+            holder, location = result[0], result[1]
+        else:
             logging.warning("Failed to query {}. Maybe no c3 data "
                             "entry.".format(cid))
             holder, location = "NA", "NA"
             print('TAI')
 
+        # RateLimit of the conf throttles the queries in case the server
+        # rejects the high frequent query
         target_data_c3.append([cid, location, holder])
-        # in case the server rejects the high frequent query
-        if sleep_counter % 100 == 0:
-            time.sleep(1)
 
     if output_filter == 'C3OEM':
         target_data_c3 = c3gdoc.filter_by_c3oem(target_data_c3)
@@ -66,93 +66,95 @@ def inventory(cid, cid_list, csv, certificate, enablement, status):
 
     # Currently the first machine on record in Taipei is 201101-6965
     # and the latest machine is 202111-29667
-    hwid_count = 1
-    hwid_hit = 1
-    year_count = 2006
-    year_hit = 2006
-    month_count = 1
     year_month_hit = 200607
+    # CIDs are probed up to 7 months after the last hit, and the probes of
+    # hwids_per_block hwids are queried together in bulk
+    hwids_per_block = 10
+    hardwares = {}
+
+    def lookup(full_cids):
+        missing = [full_cid for full_cid in full_cids
+                   if full_cid not in hardwares]
+        if missing:
+            hardwares.update(c3query.query_hardware_bulk(missing))
 
     for hwid in range(1, 30000):
-        looking_month =0
-        for year_count in range(2006, 2022):
-            if year_count < year_hit:
+        if hwid % hwids_per_block == 1:
+            # guess the hits do not move more than a year in a block
+            hardwares.clear()
+            months = get_months_since(year_month_hit)[:12]
+            lookup([convert_to_cid(year, month, block_hwid)
+                    for block_hwid in range(hwid, hwid + hwids_per_block)
+                    for year, month in months])
+
+        probes = [convert_to_cid(year, month, hwid)
+                  for year, month in get_months_since(year_month_hit)[:7]]
+        lookup(probes)
+        for full_cid in probes:
+            result = hardwares[full_cid]
+            if isinstance(result, c3api_utils.QueryError):
+                if result.status_code != 404:
+                    # not a missing CID, C3 could not tell for now
+                    logger.warning('Skip {}: {}'.format(full_cid, result))
                 continue
-            for month_count in range(1,13):
-                full_cid = convert_to_cid(year_count, month_count, hwid)
-                if int(full_cid[0:6]) < year_month_hit:
-                    continue
-                result = []
-                #print('trying {}'.format(full_cid))
-                try:
-                    result = c3query.query_over_api_hardware(full_cid)
-                    if result:
-                        year_month_hit = int(full_cid[0:6])
-                        year_hit = int(full_cid[0:4])
-                        cid_obj = c3cid.CID()
-                        try:
-                            location = result['location']['name']
-                        except:
-                            location = 'None'
-                        try:
-                            account = result['account']['name']
-                        except:
-                            account = 'None'
-                        try:
-                            platform_name = result['platform']['name']
-                            codename = result['platform']['codename']
-                            form_factor = result['platform']['form_factor']
-                        except:
-                            platform_name = 'None'
-                            codename = 'None'
-                            form_factor = 'None'
-                        try:
-                            canonical_contact = result['canonical_contact']['display_name']
-                        except:
-                            canonical_contact = 'None'
-                        try:
-                            holder = result['holder']['name']
-                        except:
-                            holder = 'None'
-                        """
-                        cid_obj = {'cid': result['canonical_id'],
-                                   'location': location,
-                                   'status': result['status'],
-                                   'account': account,
-                                   'project_name': result['project_name'],
-                                   'canonical_label': result['canonical_label'],
-                                   'platform_name': platform_name,
-                                   'codename': codename,
-                                   'sku': result['sku'],
-                                   'hardware_build': result['hardware_build'],
-                                   'form_factor': form_factor,
-                                   'canonical_contact': canonical_contact,
-                                   'holder': holder}
-                        """
-                        cid_obj.cid = result['canonical_id']
-                        cid_obj.location = location
-                        cid_obj.status = result['status']
-                        cid_obj.account = account
-                        cid_obj.project_name = result['project_name']
-                        cid_obj.canonical_label = result['canonical_label']
-                        cid_obj.platform_name = platform_name
-                        cid_obj.codename = codename
-                        cid_obj.sku = result['sku']
-                        cid_obj.hardware_build = result['hardware_build']
-                        cid_obj.form_factor = form_factor
-                        cid_obj.canonical_contact = canonical_contact
-                        cid_obj.holder = holder
-                        print(cid_obj.cid)
-                        cid_objs.append(cid_obj)
-                        break
-                except c3api_utils.QueryError:
-                    looking_month += 1
-                if looking_month > 6:
-                    break
-            if result:
-                break
-            if looking_month > 6:
-                break
+
+            year_month_hit = int(full_cid[0:6])
+            cid_obj = c3cid.CID()
+            try:
+                location = result['location']['name']
+            except:
+                location = 'None'
+            try:
+                account = result['account']['name']
+            except:
+                account = 'None'
+            try:
+                platform_name = result['platform']['name']
+                codename = result['platform']['codename']
+                form_factor = result['platform']['form_factor']
+            except:
+                platform_name = 'None'
+                codename = 'None'
+                form_factor = 'None'
+            try:
+                canonical_contact = result['canonical_contact']['display_name']
+            except:
+                canonical_contact = 'None'
+            try:
+                holder = result['holder']['name']
+            except:
+                holder = 'None'
+            """
+            cid_obj = {'cid': result['canonical_id'],
+                       'location': location,
+                       'status': result['status'],
+                       'account': account,
+                       'project_name': result['project_name'],
+                       'canonical_label': result['canonical_label'],
+                       'platform_name': platform_name,
+                       'codename': codename,
+                       'sku': result['sku'],
+                       'hardware_build': result['hardware_build'],
+                       'form_factor': form_factor,
+                       'canonical_contact': canonical_contact,
+                       'holder': holder}
+            """
+            cid_obj.cid = result['canonical_id']
+            cid_obj.location = location
+            cid_obj.status = result['status']
+            cid_obj.account = account
+            cid_obj.project_name = result['project_name']
+            cid_obj.canonical_label = result['canonical_label']
+            cid_obj.platform_name = platform_name
+            cid_obj.codename = codename
+            cid_obj.sku = result['sku']
+            cid_obj.hardware_build = result['hardware_build']
+            cid_obj.form_factor = form_factor
+            cid_obj.canonical_contact = canonical_contact
+            cid_obj.holder = holder
+            print(cid_obj.cid)
+            cid_objs.append(cid_obj)
+            break
     if csv:
         c3csv.generate_csv(cid_objs, csv, mode='inventory')
 
@@ -165,6 +167,19 @@ def read_cids(cid_list_file):
 
     return rtn
 
+def get_months_since(year_month, last_year=2021):
+    """
+    Get the months from year_month to the end of last_year.
+
+    :param year_month: int, e.g. 200607
+    :return: list of (year, month)
+    """
+    return [(year, month)
+            for year in range(year_month // 100, last_year + 1)
+            for month in range(1, 13)
+            if year * 100 + month >= year_month]
+
+
 def convert_to_cid(year, month, hwid):
     month = str(month).zfill(2)
     rtn = '{:4d}{}-{}'.format(year, month, hwid)
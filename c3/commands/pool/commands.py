@@ -1,4 +1,5 @@
 import click
+import c3.api.api as c3api
 import c3.api.cids as cids
 import c3.io.csv as c3csv
 from c3.shrink import shrink
@@ -53,11 +54,18 @@ def create_prototype(algorithm, certificate):
               help='If true to output csv file with name'
               'location-certificate-enablement-status-after-shrink-'
               'not-selected.csv')
+@click.option('--resume/--no-resume',
+              default=False,
+              help='Resume the certificate query from the checkpoint left '
+                   'by a failed run.')
 def create(location, certificate, enablement, status,
-           csv_before_shrink, csv_after_shrink, csv_after_shrink_not_selected):
+           csv_before_shrink, csv_after_shrink, csv_after_shrink_not_selected,
+           resume):
     """
     Create a test pool by given categories.
     """
+    c3api.API.get_instance().api.resume = resume
+
     cid_objs = cids.get_cids(location, certificate, enablement, status,
                              use_cache=True)
 
@@ -2,9 +2,12 @@ import click
 import logging
 import c3.pool.cid as c3cid
 import c3.api.cids as c3cids
+import c3.api.api as c3api
 import c3.api.query as c3query
+import c3.api.api_utils as c3api_utils
 import c3.io.cache as c3cache
 import c3.io.csv as c3csv
+import c3.io.cid_list as c3cid_list
 import c3.maptable as c3maptable
 import c3.json.component as c3component
 
@@ -127,10 +130,12 @@ def location(holder, location, status, eol, verbose, cid, cid_list):
 
 
 def query_location_holder(cids, verbose=False):
-    for cid_to_change in cids:
-        ctc = cid_to_change
-        holder_asis, location_asis, status_asis, platform_name = \
-            c3query.query_holder_location(ctc)
+    results = c3query.query_holder_locations(cids)
+    for ctc, result in zip(cids, results):
+        if isinstance(result, c3api_utils.QueryError):
+            print('{}, failed to query: {}'.format(ctc, result))
+            continue
+        holder_asis, location_asis, status_asis, platform_name = result
         if verbose:
             print('====== CID %s ======' % ctc)
             print('Current platform name: %s' % platform_name)
@@ -144,30 +149,38 @@ def query_location_holder(cids, verbose=False):
 
 def change_location_holder(cids, location, holder, status):
     for cid_to_change in cids:
-        ctc = cid_to_change
-        holder_asis, location_asis, status_asis, platform_name = \
-            c3query.query_holder_location(ctc)
-        print('============ CID %s ============' % ctc)
-        print('Current platform name: %s' % platform_name)
-        print('Current location: %s' % location_asis)
-        print('Current holder: %s' % holder_asis)
-        print('Current status: %s' % status_asis)
-        print('\nChanging holder and location...\n')
-        if not holder:
-            holder = holder_asis
-        if not location:
-            location = location_asis
-        if not status:
-            status = status_asis
-        c3query.push_holder(ctc, holder)
-        c3query.push_location(ctc, location)
-        c3query.push_status(ctc, status)
-        print('\nChanged.\n')
-        holder_asis, location_asis, status_asis, platform_name = \
-            c3query.query_holder_location(ctc)
-        print('Current location: %s' % location_asis)
-        print('Current holder: %s' % holder_asis)
-        print('Current status: %s' % status_asis)
+        try:
+            change_cid_location_holder(cid_to_change, location, holder,
+                                       status)
+        except c3api_utils.CircuitOpenError as excp:
+            # skip the CID wherever the circuit opens, before or after push
+            logger.warning('Skip {}: {}'.format(cid_to_change, excp))
+
+
+def change_cid_location_holder(ctc, location, holder, status):
+    holder_asis, location_asis, status_asis, platform_name = \
+        c3query.query_holder_location(ctc)
+    print('============ CID %s ============' % ctc)
+    print('Current platform name: %s' % platform_name)
+    print('Current location: %s' % location_asis)
+    print('Current holder: %s' % holder_asis)
+    print('Current status: %s' % status_asis)
+    print('\nChanging holder and location...\n')
+    if not holder:
+        holder = holder_asis
+    if not location:
+        location = location_asis
+    if not status:
+        status = status_asis
+    c3query.push_holder(ctc, holder)
+    c3query.push_location(ctc, location)
+    c3query.push_status(ctc, status)
+    print('\nChanged.\n')
+    holder_asis, location_asis, status_asis, platform_name = \
+        c3query.query_holder_location(ctc)
+    print('Current location: %s' % location_asis)
+    print('Current holder: %s' % holder_asis)
+    print('Current status: %s' % status_asis)
 
 
 def read_cids(cid_list_file):
@@ -195,7 +208,11 @@ def read_cids(cid_list_file):
 @click.option('--cache/--no-cache',
               default=True,
               help='Try to use cache or not')
-def eol(series, office, verbose, cache):
+@click.option('--resume/--no-resume',
+              default=False,
+              help='Resume the certificate query from the checkpoint left '
+                   'by a failed run.')
+def eol(series, office, verbose, cache, resume):
     """
     Find out all EOL CIDs
 
@@ -217,16 +234,18 @@ def eol(series, office, verbose, cache):
     """
     logger.info("Begin to execute.")
 
+    c3api.API.get_instance().api.resume = resume
+
     cache_prefix = 'eol-' + series
     if cache:
         logging.info('Try to use eol cache data...')
         cid_cert_objs = c3cache.read_cache(cache_prefix)
         if not cid_cert_objs:
-            cid_cert_objs = get_eol_cid_objs(series, office)
+            cid_cert_objs = get_eol_cid_objs(series, office, use_cache=cache)
             c3cache.write_cache(cache_prefix, cid_cert_objs)
 
     else:
-        cid_cert_objs = get_eol_cid_objs(series, office)
+        cid_cert_objs = get_eol_cid_objs(series, office, use_cache=cache)
 
     if verbose:
         if cache:
@@ -246,17 +265,32 @@ def eol(series, office, verbose, cache):
         c3csv.generate_csv(cid_cert_objs, 'EOL-CIDs.csv', mode='eol')
 
 
-def get_verbose_eol_cid_objs(cid_cert_objs):
+def get_verbose_eol_cid_objs(cid_cert_objs,
+                             failed_cid_list='failed-cids.txt'):
+    """
+    Get the platform and components of EOL CIDs.
+
+    CIDs failing to be queried are retried after all the others, and
+    those still failing are skipped and written to failed_cid_list.
+    """
     verbose_cid_cert_objs = []
     total_num = len(cid_cert_objs)
     counter = 1
-    for cid_cert_obj in cid_cert_objs:
+    hardwares = c3query.query_over_api_hardwares(
+        [cid_cert_obj['cid'] for cid_cert_obj in cid_cert_objs])
+    submissions = [cid_cert_obj['submission'] for cid_cert_obj in cid_cert_objs
+                   if cid_cert_obj['submission'] != '']
+    devices = dict(c3query.iter_submission_devices_bulk(submissions))
+
+    failed_cids = []
+    for cid_cert_obj, result in zip(cid_cert_objs, hardwares):
         cid_obj = c3cid.CID()
         cid_obj.cid = cid_cert_obj['cid']
         msg_template = "Fetching data of {}: {} out of {}"
         logging.info(msg_template.format(cid_obj.cid,
                                          counter,
                                          total_num))
+        counter += 1
 
         cid_obj.location = cid_cert_obj['location']
         cid_obj.release = cid_cert_obj['release']
@@ -264,19 +298,30 @@ def get_verbose_eol_cid_objs(cid_cert_objs):
         cid_obj.status = cid_cert_obj['status']
         cid_obj.cert = cid_cert_obj['cert']
 
-        result = c3query.query_over_api_hardware(cid_cert_obj['cid'])
-        cid_obj.make = result['platform']['vendor']['name']
-        cid_obj.model = result['platform']['name']
-        cid_obj.codename = result['platform']['codename']
-        cid_obj.form_factor = result['platform']['form_factor']
+        submission = cid_cert_obj['submission']
+        if isinstance(result, c3api_utils.QueryError) or \
+           isinstance(devices.get(submission), c3api_utils.QueryError):
+            logger.warning('Skip {} for failed query.'.format(cid_obj.cid))
+            failed_cids.append(cid_obj.cid)
+            continue
+
+        platform = result['platform']
+        if platform is None:
+            logger.warning('{} has no platform.'.format(cid_obj.cid))
+            platform = {}
+        vendor = platform.get('vendor') or {}
+        cid_obj.make = vendor.get('name', '')
+        cid_obj.model = platform.get('name', '')
+        cid_obj.codename = platform.get('codename', '')
+        cid_obj.form_factor = platform.get('form_factor', '')
 
         print(cid_cert_obj)
-        if cid_cert_obj['submission'] == '':
+        if submission == '':
             cid_obj.processor = ''
             cid_obj.video = ''
             cid_obj.wireless = ''
         else:
-            result = c3query.query_submission_devices(cid_cert_obj['submission'])
+            result = devices[submission]
             try:
                 cid_obj.processor = c3component.get_component(result, 'PROCESSOR')[1]
             except:
@@ -289,12 +334,13 @@ def get_verbose_eol_cid_objs(cid_cert_objs):
 
         verbose_cid_cert_objs.append(cid_obj)
 
-        counter += 1
+    if failed_cids and failed_cid_list:
+        c3cid_list.write_cid_list(failed_cids, failed_cid_list)
 
     return verbose_cid_cert_objs
 
 
-def get_eol_cid_objs(series, office):
+def get_eol_cid_objs(series, office, use_cache=False):
 
     releases = c3maptable.series_eol[series]
     locations = c3maptable.office[office]
@@ -303,8 +349,11 @@ def get_eol_cid_objs(series, office):
     cid_cert_objs = []
     for location in locations:
 
-        summaries = c3cids.get_certificates_by_location(location,
-                                                        use_cache=False)
+        # is_eol still checks the certificates in case C3 ignores the
+        # filter, and cached ones are used only if they are synced
+        summaries = c3cids.iter_certificates_by_location(
+            location, use_cache=use_cache and c3cids.is_cache_synced(),
+            filters={'release__release__in': ','.join(releases)})
 
         for summary in summaries:
             if is_eol(summary, releases, c3maptable.series_alive):
@@ -0,0 +1,85 @@
+"""
+Handle checkpoints of paginated queries.
+
+A checkpoint is a journal of pickled records, one record per downloaded
+page. Each record carries the objects of the page, the state needed to
+query the next page and when it was written, so an interrupted query could
+resume from the page where it failed if the checkpoint is not too old.
+"""
+import logging
+import os
+import time
+import pickle
+
+
+logger = logging.getLogger('c3_web_query')
+
+
+def get_checkpoint_fn(directory, key):
+    """
+    Get the checkpoint file name of a query.
+
+    :param directory: where to put the checkpoint
+    :param key: digest of the query, see api_utils.request_digest
+    :return: string, checkpoint file path
+    """
+    return os.path.join(directory, 'batch-' + key[:16] + '.checkpoint.pickle')
+
+
+def read_checkpoint(checkpoint_fn, max_age=None):
+    """
+    Read every record of a checkpoint.
+
+    A truncated last record, e.g. the process was killed while writing it,
+    is dropped.
+
+    :param checkpoint_fn: checkpoint file path
+    :param max_age: seconds since the first record a checkpoint could be
+                    used, None for ever
+    :return: list of records, empty if there is no checkpoint or it is
+             too old
+    """
+    records = []
+    try:
+        with open(checkpoint_fn, 'rb') as handle:
+            while True:
+                try:
+                    records.append(pickle.load(handle))
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    logger.warning('Drop the truncated checkpoint record.')
+                    break
+    except FileNotFoundError:
+        logger.debug('Checkpoint not found: %s' % checkpoint_fn)
+
+    if records and max_age is not None:
+        # checkpoints written before the time was recorded are too old
+        written_at = records[0].get('written_at', 0)
+        if time.time() - written_at > max_age:
+            logger.warning('Checkpoint %s is older than %s seconds, query '
+                           'from the first page.' % (checkpoint_fn, max_age))
+            return []
+
+    return records
+
+
+def open_checkpoint(checkpoint_fn, append=False):
+    directory = os.path.dirname(checkpoint_fn)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    mode = 'ab' if append else 'wb'
+
+    return open(checkpoint_fn, mode)
+
+
+def write_checkpoint(handle, record):
+    pickle.dump(dict(record, written_at=time.time()), handle)
+    handle.flush()
+
+
+def remove_checkpoint(checkpoint_fn):
+    try:
+        os.remove(checkpoint_fn)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,17 @@
+"""
+Handle CID list io.
+
+A CID list is a text file with one CID per row, the format read by the
+--cid-list option.
+"""
+import logging
+import os
+
+
+def write_cid_list(cids, cid_list_file='failed-cids.txt'):
+    with open(cid_list_file, 'w') as handle:
+        for cid in cids:
+            handle.write(cid + '\n')
+        logging.warning('{} CIDs are written to {}. Query them again with '
+                        '--cid-list.'.format(len(cids),
+                                             os.path.realpath(handle.name)))
@@ -0,0 +1,133 @@
+"""
+Handle the on-disk cache of C3 responses.
+
+Responses are kept in a SQLite database keyed by api_utils.request_digest
+of url and request parameters, without the credentials, so the cache could
+be shared by different users.
+"""
+import time
+import logging
+import sqlite3
+import hashlib
+import threading
+
+
+logger = logging.getLogger('c3_web_query')
+
+
+class ResponseCache(object):
+    """
+    SQLite cache of response bodies shared by all threads.
+
+    The validators of a response, ETag and Last-Modified, are kept with
+    its body so a stale response could be revalidated by a conditional
+    request. The hash of the body is kept too, to tell whether a response
+    without validators has changed.
+    """
+
+    columns = [('etag', 'TEXT'),
+               ('last_modified', 'TEXT'),
+               ('body_hash', 'TEXT')]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, '
+                'url TEXT, '
+                'body BLOB, '
+                'stored_at REAL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_url ON responses (url)')
+            # caches created before the validators were kept
+            existing = [row[1] for row in self.connection.execute(
+                'PRAGMA table_info(responses)')]
+            for column, column_type in self.columns:
+                if column not in existing:
+                    self.connection.execute(
+                        'ALTER TABLE responses ADD COLUMN {} {}'.format(
+                            column, column_type))
+
+    def get(self, key, ttl):
+        """
+        Get a response body if it is fresh.
+
+        :param key: cache key of the request
+        :param ttl: seconds a response stays fresh, negative for ever
+        :return: body in bytes, None if not found or stale
+        """
+        entry = self.lookup(key)
+        if entry is None or not is_fresh(entry, ttl):
+            return None
+
+        return entry['body']
+
+    def lookup(self, key):
+        """
+        Get a cached response, fresh or not.
+
+        :param key: cache key of the request
+        :return: dictionary of body, stored_at, etag, last_modified and
+                 body_hash, None if not found
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body, stored_at, etag, last_modified, body_hash '
+                'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        return {'body': bytes(row[0]),
+                'stored_at': row[1],
+                'etag': row[2],
+                'last_modified': row[3],
+                'body_hash': row[4]}
+
+    def set(self, key, url, body, etag=None, last_modified=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, url, body, stored_at, etag, last_modified, body_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, url, sqlite3.Binary(body), time.time(),
+                 etag, last_modified, body_hash(body)))
+
+    def touch(self, key):
+        """
+        Mark a cached response fresh again, e.g. after it is revalidated.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE responses SET stored_at = ? WHERE key = ?',
+                (time.time(), key))
+
+    def invalidate(self, url):
+        """
+        Drop the responses of url, with or without the trailing slash.
+
+        :param url: url of the resource
+        """
+        url = url.rstrip('/')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM responses WHERE url = ? OR url = ?',
+                (url, url + '/'))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def is_fresh(entry, ttl):
+    """
+    :param entry: cached response of ResponseCache.lookup
+    :param ttl: seconds a response stays fresh, negative for ever
+    """
+    return ttl < 0 or time.time() - entry['stored_at'] < ttl
+
+
+def body_hash(body):
+    return hashlib.sha1(body).hexdigest()
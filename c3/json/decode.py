@@ -0,0 +1,81 @@
+"""
+Decode C3 responses in json.
+
+orjson is used to parse if it is installed, otherwise the standard json
+module. Decoded objects could be projected down to the fields we use so
+the rest are dropped right after parsing.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(content):
+    """
+    Parse json.
+
+    :param content: json in bytes
+    :return: decoded object, raise ValueError if it is not valid json
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+
+    return json.loads(content.decode('utf-8'))
+
+
+def project(obj, fields):
+    """
+    Keep only the given fields of a dictionary.
+
+    A field could be a dotted path to a nested field, e.g. 'release.release'
+    keeps {'release': {'release': ...}} only. Missing fields are skipped.
+
+    :param obj: dictionary
+    :param fields: list of field paths
+    :return: dictionary
+    """
+    projected = {}
+    for field in fields:
+        keys = field.split('.')
+        source = obj
+        target = projected
+        for key in keys[:-1]:
+            if not isinstance(source, dict) or key not in source:
+                break
+            source = source[key]
+            if not isinstance(source, dict):
+                # e.g. None where a related object is expected
+                target[key] = source
+                break
+            target = target.setdefault(key, {})
+        else:
+            if isinstance(source, dict) and keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+
+    return projected
+
+
+def project_document(document, fields=None):
+    """
+    Project a decoded response.
+
+    The objects of a list response are projected one by one, and its meta
+    is kept. Any other response is projected as a whole.
+
+    :param document: decoded response
+    :param fields: list of field paths, None to keep everything
+    :return: decoded response
+    """
+    if fields is None or not isinstance(document, dict):
+        return document
+
+    if isinstance(document.get('objects'), list):
+        projected = dict(document)
+        projected['objects'] = [project(obj, fields)
+                                for obj in document['objects']]
+        return projected
+
+    return project(document, fields)
@@ -49,4 +49,11 @@ device_audio_attr = ['audio_pciid', 'audio_name']
 
 comprehensive_cid_attr = machine_metainfo_attr + device_audio_attr
 
+# fields of the C3 responses in use, the others are dropped when decoding
+# id, updated_at and resource_uri let the cached certificates be synced
+certificate_fields = ['machine', 'report', 'release.release', 'level',
+                      'status', 'id', 'updated_at', 'resource_uri']
+
+device_fields = ['bus', 'category.name', 'identifier', 'name']
+
 ifamily_series = ['i3', 'i5', 'i7']
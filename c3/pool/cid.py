@@ -3,6 +3,7 @@ Pool entry data model. It's a CID most of the time.
 """
 import c3.json.component as c3component
 import c3.api.query as c3query
+from c3.api.api_utils import QueryError
 from pprint import pprint
 
 
@@ -27,5 +28,38 @@ def get_cid_from_submission(submission_id):
     return cid
 
 
+def build_cids_from_submissions(submission_ids):
+    """
+    Build the CID objects of many submissions.
+
+    The machine reports and the devices of the submissions are queried in
+    bulk.
+
+    :param submission_ids: submission ids, list of string
+    :return: list of CID objects in the order of submission_ids,
+             QueryError for the failed submissions
+    """
+    machine_reports = c3query.query_machine_reports_bulk(submission_ids)
+
+    # build the CIDs as the devices stream in, without keeping the devices
+    cids = {}
+    for submission_id, device_report in \
+            c3query.iter_submission_devices_bulk(submission_ids):
+        machine_report = machine_reports[submission_id]
+        if isinstance(machine_report, QueryError):
+            cids[submission_id] = machine_report
+            continue
+        if isinstance(device_report, QueryError):
+            cids[submission_id] = device_report
+            continue
+
+        cid = CID()
+        cid.__dict__.update(**c3component.get_machine_info(machine_report))
+        cid.__dict__.update(**c3component.get_audio_component(device_report))
+        cids[submission_id] = cid
+
+    return [cids[str(submission_id)] for submission_id in submission_ids]
+
+
 def dump_cid_obj(cid_obj):
     pprint(vars(cid_obj))
@@ -0,0 +1,587 @@
+"""
+A local stand-in of the C3 tastypie API for load and scaling tests.
+
+The server generates synthetic CIDs, certificates, machine reports and
+devices, and serves the endpoints of the [API] section:
+
+    /api/v1/certificates/?machine__location=<id>&release__release=<release>
+    /api/v1/certificates/?machine__location=<id>&updated_at__gte=<time>
+    /api/v1/hardware/?canonical_id__in=<cid>,<cid>
+    /api/v1/hardware/<cid>/                      GET and PATCH
+    /api/v1/machinereports/<id>/
+    /api/v1/machinereports/<id>/report_devices/
+    /api/v1/machinereports/find/?id=<id>
+    /api/v1/machinereports/find/?id__in=<id>,<id>
+    /api/v1/reportdevices/?report__in=<id>,<id>
+    /api/v1/locations/
+
+Lists are paginated by offset and limit with meta.next links. Latency,
+errors and rate limits could be injected to see how the clients cope.
+Responses carry an ETag and are gzipped if the client accepts it.
+
+Run it by:
+
+    python -m c3.testing.fake_c3 --cids 5000 --latency 0.05 --conf fake.ini
+    c3-cli --conf fake.ini eol --no-cache
+"""
+import re
+import sys
+import json
+import gzip
+import time
+import random
+import logging
+import datetime
+import hashlib
+import threading
+import configparser
+import click
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, urlencode
+import c3.maptable
+
+
+logger = logging.getLogger('c3_web_query')
+
+api_paths = {'location': '/api/v1/certificates/?machine__location=',
+             'hardware': '/api/v1/hardware/',
+             'machineReport': '/api/v1/machinereports/',
+             'reportFind': '/api/v1/machinereports/find/',
+             'reportDevices': '/api/v1/reportdevices/',
+             'locations': '/api/v1/locations/'}
+
+vendors = ['Dell', 'HP', 'Lenovo', 'ASUS', 'Acer']
+form_factors = ['Laptop', 'Desktop', 'All In One', 'Server']
+devices = [('PROCESSOR', 'cpu', ['Intel(R) Core(TM) i{}-{}U CPU'.format(
+                family, model) for family in (3, 5, 7)
+                for model in (6100, 7200, 8250)]),
+           ('VIDEO', 'pci', ['HD Graphics {}'.format(model)
+                             for model in (520, 620, 630)]),
+           ('WIRELESS', 'pci', ['Wireless-AC {}'.format(model)
+                                for model in (3165, 8265, 9560)]),
+           ('NETWORK', 'pci', ['Ethernet Connection I219-{}'.format(model)
+                               for model in ('LM', 'V')]),
+           ('AUDIO', 'pci', ['Sunrise Point-LP HD Audio',
+                             'Cannon Point-LP High Definition Audio'])]
+
+
+class FakeC3Data(object):
+    """
+    Synthetic C3 records of cid_count CIDs, the same for the same seed.
+
+    Every CID has one to three certificates, each with its own machine
+    report and devices, and is placed in one of the known locations.
+    """
+
+    def __init__(self, cid_count=100, seed=0):
+        rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.locations = dict((location_id, name) for name, location_id
+                              in c3.maptable.location.items())
+        releases = sorted(set(
+            release for series in c3.maptable.series_eol.values()
+            for release in series) | set(c3.maptable.series_alive))
+
+        self.hardware = {}
+        self.reports = {}
+        self.devices = {}
+        self.certificates = []
+        report_id = 1000
+        for index in range(cid_count):
+            cid = '{}-{:05d}'.format(rand.choice(['201404', '201610',
+                                                  '201801', '201903']),
+                                     10000 + index)
+            location_id = rand.choice(sorted(self.locations))
+            vendor = rand.choice(vendors)
+            platform = {'name': '{} {}'.format(vendor, 1000 + index % 97),
+                        'codename': 'codename-{}'.format(index % 53),
+                        'form_factor': rand.choice(form_factors),
+                        'vendor': {'name': vendor}}
+            self.hardware[cid] = {
+                'canonical_id': cid,
+                'resource_uri': api_paths['hardware'] + cid + '/',
+                'holder': self._holder('holder-{}'.format(index % 7)),
+                'location': self._location(location_id),
+                'status': 'With Canonical',
+                'platform': platform,
+                'account': {'name': vendor},
+                'project_name': 'project-{}'.format(index % 11),
+                'canonical_label': 'label-{}'.format(index),
+                'sku': 'sku-{}'.format(index),
+                'hardware_build': rand.choice(['EVT', 'DVT', 'PVT', 'MP']),
+                'canonical_contact': self._holder('contact-{}'.format(
+                    index % 3))}
+
+            for _ in range(rand.randint(1, 3)):
+                report_id += 1
+                report_devices = [
+                    {'bus': bus, 'category': {'name': category},
+                     'identifier': '8086:{:04x}'.format(
+                         rand.randint(0, 65535)),
+                     'name': rand.choice(names)}
+                    for category, bus, names in devices]
+                self.devices[report_id] = report_devices
+                by_category = dict((device['category']['name'],
+                                    device['name'])
+                                   for device in report_devices)
+                self.reports[report_id] = {
+                    'id': report_id,
+                    'canonical_id': cid,
+                    'resource_uri': '{}{}/'.format(api_paths['machineReport'],
+                                                   report_id),
+                    'created_at': '2018-01-{:02d}T00:00:00'.format(
+                        report_id % 28 + 1),
+                    'make': vendor,
+                    'model': platform['name'],
+                    'codename': platform['codename'],
+                    'form_factor': platform['form_factor'],
+                    'processor': by_category['PROCESSOR'],
+                    'video': by_category['VIDEO'],
+                    'wireless': by_category['WIRELESS'],
+                    'network': by_category['NETWORK'],
+                    'kernel': '4.{}.0-{}-generic'.format(rand.choice(
+                        [4, 13, 15]), rand.randint(10, 60)),
+                    'location': self.locations[location_id]}
+                certificate_id = len(self.certificates) + 1
+                self.certificates.append({
+                    'id': certificate_id,
+                    'resource_uri': '/api/v1/certificates/{}/'.format(
+                        certificate_id),
+                    'machine': api_paths['hardware'] + cid + '/',
+                    'report': self.reports[report_id]['resource_uri'],
+                    'release': {'release': rand.choice(releases)},
+                    'level': rand.choice(['Enabled', 'Certified']),
+                    'status': 'Complete - Pass',
+                    'updated_at': self.reports[report_id]['created_at'],
+                    'location': location_id})
+
+        self.location_certificates = {}
+        for certificate in self.certificates:
+            self.location_certificates.setdefault(
+                certificate['location'], []).append(certificate)
+
+    @staticmethod
+    def _holder(name):
+        return {'name': name, 'display_name': name}
+
+    def _location(self, location_id):
+        return {'id': int(location_id),
+                'name': self.locations[location_id],
+                'resource_uri': '{}{}/'.format(api_paths['locations'],
+                                               location_id)}
+
+    def certificates_by_location(self, location_id):
+        return self.location_certificates.get(location_id, [])
+
+    def patch_hardware(self, cid, changes):
+        """
+        Apply a PATCH of the hardware api, holder and location are given
+        by their resource uris.
+        """
+        with self.lock:
+            hardware = self.hardware[cid]
+            if 'holder' in changes:
+                hardware['holder'] = self._holder(
+                    changes['holder'].rstrip('/').split('/')[-1])
+            if 'location' in changes:
+                location_id = changes['location'].rstrip('/').split('/')[-1]
+                hardware['location'] = self._location(location_id)
+            if 'status' in changes:
+                hardware['status'] = changes['status']
+
+    def update_certificate(self, certificate_id, changes):
+        """
+        Change the fields of a certificate, e.g. its status, and bump its
+        updated_at.
+        """
+        with self.lock:
+            certificate = self.certificates[certificate_id - 1]
+            certificate.update(changes)
+            certificate['updated_at'] = self._now()
+
+    def add_certificate(self, cid, release, level,
+                        status='Complete - Pass'):
+        """
+        Certify cid for another release on its latest machine report.
+
+        :return: the new certificate
+        """
+        with self.lock:
+            report_id = max(report['id'] for report in self.reports.values()
+                            if report['canonical_id'] == cid)
+            location_id = str(self.hardware[cid]['location']['id'])
+            certificate_id = len(self.certificates) + 1
+            certificate = {
+                'id': certificate_id,
+                'resource_uri': '/api/v1/certificates/{}/'.format(
+                    certificate_id),
+                'machine': api_paths['hardware'] + cid + '/',
+                'report': self.reports[report_id]['resource_uri'],
+                'release': {'release': release},
+                'level': level,
+                'status': status,
+                'updated_at': self._now(),
+                'location': location_id}
+            self.certificates.append(certificate)
+            self.location_certificates.setdefault(location_id, []).append(
+                certificate)
+
+        return certificate
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.utcnow().isoformat()
+
+
+class FaultPolicy(object):
+    """
+    Latency, errors and rate limits injected into every response.
+
+    Latency is drawn from a log-normal distribution with the given median
+    and sigma, a sigma of 0 for a fixed latency. error_rate of the
+    requests fail with 503. Requests over rate_limit per second are
+    answered by 429 with Retry-After, 0 for no limit.
+    """
+
+    def __init__(self, latency=0.0, latency_sigma=0.0, error_rate=0.0,
+                 rate_limit=0, seed=None):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = max(1.0, rate_limit)
+        self.updated_at = time.monotonic()
+
+    def delay(self):
+        if self.latency <= 0:
+            return 0.0
+        with self.lock:
+            return self.random.lognormvariate(0, self.latency_sigma) * \
+                self.latency
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def limited(self):
+        """
+        :return: True if the request is over the rate limit
+        """
+        if self.rate_limit <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate_limit), self.tokens +
+                              (now - self.updated_at) * self.rate_limit)
+            self.updated_at = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+
+        return False
+
+
+# parameters of a list which are not filters
+list_params = ['offset', 'limit', 'format', 'order_by', 'username',
+               'api_key', 'machine__location']
+
+# the certificate filters, (field getter, match of the field and the value)
+certificate_filters = {
+    'release__release': (lambda cert: cert['release']['release'],
+                         lambda field, value: field == value),
+    'release__release__in': (lambda cert: cert['release']['release'],
+                             lambda field, value: field in value.split(',')),
+    'level': (lambda cert: cert['level'],
+              lambda field, value: field == value),
+    'status': (lambda cert: cert['status'],
+               lambda field, value: field == value),
+    'id__gt': (lambda cert: cert['id'],
+               lambda field, value: field > int(value)),
+    'updated_at__gte': (lambda cert: cert['updated_at'],
+                        lambda field, value: field >= value)}
+
+
+class FakeC3Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [('GET', re.compile(r'^/api/v1/certificates/$'),
+               'get_certificates'),
+              ('GET', re.compile(r'^/api/v1/hardware/$'),
+               'list_hardware'),
+              ('GET', re.compile(r'^/api/v1/hardware/([^/]+)/?$'),
+               'get_hardware'),
+              ('PATCH', re.compile(r'^/api/v1/hardware/([^/]+)/?$'),
+               'patch_hardware'),
+              ('GET', re.compile(r'^/api/v1/machinereports/find/$'),
+               'find_reports'),
+              ('GET', re.compile(r'^/api/v1/machinereports/(\d+)/'
+                                 r'report_devices/$'),
+               'get_report_devices'),
+              ('GET', re.compile(r'^/api/v1/machinereports/(\d+)/?$'),
+               'get_report'),
+              ('GET', re.compile(r'^/api/v1/reportdevices/$'),
+               'list_report_devices'),
+              ('GET', re.compile(r'^/api/v1/locations/$'),
+               'get_locations')]
+
+    def log_message(self, format, *args):
+        logger.debug('fake C3: ' + format % args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        self.query = dict((key, values[-1]) for key, values
+                          in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        faults = self.server.faults
+        if faults.limited():
+            return self.reply(429, {'error': 'rate limited'},
+                              {'Retry-After': '1'})
+        delay = faults.delay()
+        if delay:
+            time.sleep(delay)
+        if faults.fail():
+            return self.reply(503, {'error': 'injected failure'})
+
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                return getattr(self, name)(url.path, *match.groups())
+
+        self.reply(404, {'error': 'not found'})
+
+    def reply(self, status_code, content, headers=None):
+        body = json.dumps(content, sort_keys=True).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        headers = dict(headers or {})
+        if status_code == 200:
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status_code, body = 304, b''
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_list(self, path, objects):
+        """
+        Reply a tastypie list of objects paginated by offset and limit.
+        """
+        total_count = len(objects)
+        offset = int(self.query.get('offset', 0))
+        limit = int(self.query.get('limit', self.server.page_size))
+        if limit <= 0:
+            limit = total_count
+        end = min(offset + limit, total_count)
+        next_query = None
+        if end < total_count:
+            query = dict(self.query, offset=end, limit=limit)
+            next_query = path + '?' + urlencode(sorted(query.items()))
+        meta = {'limit': limit, 'offset': offset,
+                'total_count': total_count, 'next': next_query}
+
+        self.reply(200, {'meta': meta, 'objects': objects[offset:end]})
+
+    def get_certificates(self, path):
+        location_id = self.query.get('machine__location')
+        certificates = self.server.data.certificates_by_location(location_id)
+
+        filters = dict((name, value) for name, value in self.query.items()
+                       if name not in list_params)
+        if filters and not self.server.filtering:
+            return self.reply(400, {'error': 'filtering is not allowed'})
+        for name, value in filters.items():
+            if name not in certificate_filters:
+                return self.reply(400, {'error': 'cannot filter by ' + name})
+            field, match = certificate_filters[name]
+            certificates = [certificate for certificate in certificates
+                            if match(field(certificate), value)]
+
+        self.reply_list(path, certificates)
+
+    def list_hardware(self, path):
+        hardware = self.server.data.hardware
+        cids = sorted(hardware)
+        if 'canonical_id__in' in self.query:
+            cids = [cid for cid in self.query['canonical_id__in'].split(',')
+                    if cid in hardware]
+        self.reply_list(path, [hardware[cid] for cid in cids])
+
+    def get_hardware(self, path, cid):
+        hardware = self.server.data.hardware.get(cid)
+        if hardware is None:
+            return self.reply(404, {'error': 'no such CID'})
+        self.reply(200, hardware)
+
+    def patch_hardware(self, path, cid):
+        if cid not in self.server.data.hardware:
+            return self.reply(404, {'error': 'no such CID'})
+        try:
+            changes = json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return self.reply(400, {'error': 'invalid json'})
+        self.server.data.patch_hardware(cid, changes)
+        self.reply(202, {})
+
+    def find_reports(self, path):
+        reports = self.server.data.reports
+        if 'id__in' in self.query:
+            objects = [reports[int(report_id)] for report_id
+                       in self.query['id__in'].split(',')
+                       if int(report_id) in reports]
+        elif 'id' in self.query:
+            report = reports.get(int(self.query['id']))
+            objects = [report] if report else []
+        else:
+            cid = self.query.get('canonical_id')
+            objects = [report for report in reports.values()
+                       if cid is None or report['canonical_id'] == cid]
+            if self.query.get('order_by') == '-created_at':
+                objects.sort(key=lambda report: report['created_at'],
+                             reverse=True)
+        self.reply_list(path, objects)
+
+    def get_report(self, path, report_id):
+        report = self.server.data.reports.get(int(report_id))
+        if report is None:
+            return self.reply(404, {'error': 'no such report'})
+        self.reply(200, report)
+
+    def get_report_devices(self, path, report_id):
+        report_devices = self.server.data.devices.get(int(report_id))
+        if report_devices is None:
+            return self.reply(404, {'error': 'no such report'})
+        self.reply_list(path, report_devices)
+
+    def list_report_devices(self, path):
+        data = self.server.data
+        report_ids = sorted(data.devices)
+        if 'report__in' in self.query:
+            report_ids = sorted(int(report_id) for report_id
+                                in self.query['report__in'].split(','))
+        rows = [dict(device, report='{}{}/'.format(
+                    api_paths['machineReport'], report_id))
+                for report_id in report_ids
+                for device in data.devices.get(report_id, [])]
+        self.reply_list(path, rows)
+
+    def get_locations(self, path):
+        data = self.server.data
+        self.reply_list(path, [data._location(location_id)
+                               for location_id in sorted(data.locations)])
+
+
+class FakeC3Server(ThreadingMixIn, HTTPServer):
+    """
+    The fake C3 server, serving in a background thread after start().
+
+    :param data: FakeC3Data
+    :param faults: FaultPolicy, None for no faults
+    :param page_size: objects per page if the client does not ask a limit
+    :param filtering: False to reject the certificate filters like an old C3
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data=None, faults=None, host='127.0.0.1', port=0,
+                 page_size=20, filtering=True):
+        HTTPServer.__init__(self, (host, port), FakeC3Handler)
+        self.data = data or FakeC3Data()
+        self.faults = faults or FaultPolicy()
+        self.page_size = page_size
+        self.filtering = filtering
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def write_conf(self, conf_file):
+        """
+        Write a configuration file pointing c3-cli to this server.
+        """
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config['GENERAL'] = {'verbose': 'info', 'cache': 'true'}
+        config['C3'] = {'UserName': 'ubuntu', 'APIKey': 'ubuntu',
+                        'BatchQueryMode': '0', 'URI': self.url}
+        config['API'] = api_paths
+        config['SHRINK'] = {'all': 'no'}
+        config['FILTER'] = {'location': '', 'heros': ''}
+        config['CACHE'] = {'path': 'c3-response-cache.sqlite'}
+        with open(conf_file, 'w') as handle:
+            config.write(handle)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen.')
+@click.option('--port', default=8000, help='Port to listen.')
+@click.option('--cids', default=1000, help='Number of synthetic CIDs.')
+@click.option('--seed', default=0, help='Seed of the synthetic data.')
+@click.option('--page-size', default=20,
+              help='Objects per page if the client does not ask a limit.')
+@click.option('--latency', default=0.0,
+              help='Median seconds to delay every response.')
+@click.option('--latency-sigma', default=0.0,
+              help='Sigma of the log-normal latency, 0 for a fixed latency.')
+@click.option('--error-rate', default=0.0,
+              help='Ratio of the requests failing with 503.')
+@click.option('--rate-limit', default=0.0,
+              help='Requests per second before answering 429, 0 for no '
+                   'limit.')
+@click.option('--conf',
+              help='Write a c3-cli configuration file for this server.')
+def main(host, port, cids, seed, page_size, latency, latency_sigma,
+         error_rate, rate_limit, conf):
+    """
+    Serve a fake C3 API until interrupted.
+    """
+    server = FakeC3Server(FakeC3Data(cids, seed),
+                          FaultPolicy(latency, latency_sigma, error_rate,
+                                      rate_limit),
+                          host=host, port=port, page_size=page_size)
+    if conf:
+        server.write_conf(conf)
+    print('Serve fake C3 of {} CIDs at {}'.format(cids, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
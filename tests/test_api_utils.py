@@ -0,0 +1,563 @@
+import os
+import json
+import configparser
+import time
+import threading
+import pytest
+import requests
+from c3.api.api_utils import APIQuery, QueryError
+from c3.api.api_utils import CircuitBreaker, CircuitOpenError
+from c3.api.api_utils import request_key
+from c3.io.response_cache import ResponseCache
+from c3.api.endpoints import EndpointRegistry
+from c3.api.stats import LatencyHistogram
+from c3.api.throttle import INTERACTIVE, BULK
+
+
+def slow_square(number):
+    # later items finish first to make sure the order is kept
+    time.sleep(0.01 * (5 - number))
+    if number == 3:
+        raise QueryError('no such item')
+    return number * number
+
+
+def test_map_query_keep_order():
+    api = APIQuery('http://localhost', max_workers=4)
+
+    results = api.map_query(slow_square, range(5))
+
+    assert results[:3] == [0, 1, 4]
+    assert isinstance(results[3], QueryError)
+    assert results[4] == 16
+
+
+def test_map_query_serial():
+    api = APIQuery('http://localhost')
+
+    results = api.map_query(slow_square, [0, 1, 2])
+
+    assert results == [0, 1, 4]
+
+
+def make_response(content, status_code=200, headers=None):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = json.dumps(content).encode('utf-8')
+    return response
+
+
+class FakeSession(object):
+    """
+    Serve a tastypie list endpoint of total_count integers.
+    """
+
+    def __init__(self, total_count, limit, fail_offset=None):
+        self.total_count = total_count
+        self.limit = limit
+        self.fail_offset = fail_offset
+        self.offsets = []
+
+    def request(self, method, url, params=None, **kwargs):
+        params = params or {}
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', self.limit))
+        self.offsets.append(offset)
+        if offset == self.fail_offset:
+            raise requests.exceptions.ConnectionError('broken page')
+        end = min(offset + limit, self.total_count)
+        next_query = None
+        if end < self.total_count:
+            next_query = '/list/?offset={}&limit={}'.format(end, limit)
+        meta = {'limit': limit, 'offset': offset,
+                'total_count': self.total_count, 'next': next_query}
+        return make_response({'meta': meta,
+                              'objects': list(range(offset, end))})
+
+
+def test_batch_query_prefetch_pages():
+    api = APIQuery('http://localhost', max_workers=4, checkpoint_dir=None)
+    api.transport.session = FakeSession(total_count=95, limit=10)
+
+    results = api.batch_query('http://localhost/list/')
+
+    assert results == list(range(95))
+    assert sorted(api.transport.session.offsets) == list(range(0, 95, 10))
+
+
+def test_iter_batch_query_streams_pages():
+    api = APIQuery('http://localhost', max_workers=2, checkpoint_dir=None)
+    api.transport.session = FakeSession(total_count=45, limit=10)
+
+    objects = api.iter_batch_query('http://localhost/list/')
+    first_objects = [next(objects) for _ in range(10)]
+
+    # only the first page is fetched before the caller asks for more
+    assert first_objects == list(range(10))
+    assert api.transport.session.offsets == [0]
+    assert list(objects) == list(range(10, 45))
+
+
+def test_batch_query_resume_from_checkpoint(tmp_path):
+    api = APIQuery('http://localhost', max_retries=2,
+                   checkpoint_dir=str(tmp_path))
+    api.transport.session = FakeSession(total_count=45, limit=10,
+                                        fail_offset=30)
+
+    with pytest.raises(QueryError):
+        api.batch_query('http://localhost/list/')
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    api.resume = True
+    api.transport.session = FakeSession(total_count=45, limit=10)
+    results = api.batch_query('http://localhost/list/')
+
+    assert results == list(range(45))
+    assert api.transport.session.offsets == [30, 40]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_batch_query_stopped_early_drops_checkpoint(tmp_path):
+    api = APIQuery('http://localhost', checkpoint_dir=str(tmp_path))
+    api.transport.session = FakeSession(total_count=45, limit=10)
+
+    objects = api.iter_batch_query('http://localhost/list/')
+    assert [next(objects) for _ in range(15)] == list(range(15))
+    objects.close()
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_batch_query_stale_checkpoint(tmp_path):
+    api = APIQuery('http://localhost', max_retries=2,
+                   checkpoint_dir=str(tmp_path), checkpoint_max_age=0)
+    api.transport.session = FakeSession(total_count=45, limit=10,
+                                        fail_offset=30)
+
+    with pytest.raises(QueryError):
+        api.batch_query('http://localhost/list/')
+    time.sleep(0.01)
+
+    api.resume = True
+    api.transport.session = FakeSession(total_count=45, limit=10)
+    results = api.batch_query('http://localhost/list/')
+
+    # the checkpoint is too old, so every page is queried again
+    assert results == list(range(45))
+    assert api.transport.session.offsets == [0, 10, 20, 30, 40]
+
+
+class StatusSession(object):
+    """
+    Reply the given status codes in turn.
+    """
+
+    def __init__(self, status_codes, headers=None):
+        self.status_codes = list(status_codes)
+        self.headers = headers or {}
+        self.count = 0
+        self.request_headers = []
+
+    def request(self, method, url, params=None, **kwargs):
+        self.count += 1
+        self.request_headers.append(kwargs.get('headers') or {})
+        return make_response({'objects': []}, self.status_codes.pop(0),
+                             self.headers)
+
+
+def test_retry_after_service_unavailable():
+    api = APIQuery('http://localhost', backoff_max=0.1)
+    api.transport.session = StatusSession([503, 429, 200],
+                                          headers={'Retry-After': '0'})
+
+    assert api.single_query('http://localhost/item/') == {'objects': []}
+    assert api.transport.session.count == 3
+
+
+def test_not_found_fail_fast():
+    api = APIQuery('http://localhost')
+    api.transport.session = StatusSession([404, 200])
+
+    with pytest.raises(QueryError) as excinfo:
+        api.single_query('http://localhost/item/')
+    assert excinfo.value.status_code == 404
+    assert api.transport.session.count == 1
+
+
+class SlowSession(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def request(self, method, url, params=None, **kwargs):
+        self.count += 1
+        time.sleep(0.1)
+        return make_response({'url': url})
+
+
+def test_single_query_coalesce_identical_requests():
+    api = APIQuery('http://localhost', max_workers=8)
+    api.transport.session = SlowSession()
+
+    urls = ['http://localhost/a/'] * 6 + ['http://localhost/b/'] * 2
+    results = api.map_single_query(urls, params={'username': 'ubuntu'})
+
+    assert [result['url'] for result in results] == urls
+    assert api.transport.session.count == 2
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    endpoints = EndpointRegistry(profiles={'other': {'cache_ttl': 0}})
+    api = APIQuery('http://localhost', response_cache=cache,
+                   endpoints=endpoints)
+    api.transport.session = StatusSession([200] * 4)
+
+    for _ in range(3):
+        result = api.single_query('http://localhost/hardware/1',
+                                  params={'api_key': 'secret'},
+                                  endpoint='hardware')
+        assert result == {'objects': []}
+    assert api.transport.session.count == 1
+
+    # a push makes the cached resource stale
+    api.push('http://localhost/hardware/1/', data='{}')
+    api.single_query('http://localhost/hardware/1', endpoint='hardware')
+    assert api.transport.session.count == 3
+
+    # endpoints without ttl are not cached
+    api.single_query('http://localhost/other/1', endpoint='other')
+    assert api.transport.session.count == 4
+
+
+def test_request_key_without_credentials(tmp_path):
+    next_link = 'http://localhost/hardware/?api_key=secret&offset=20' \
+        '&username=ubuntu'
+
+    assert request_key(next_link, {'api_key': 'secret', 'limit': 20}) == \
+        ('http://localhost/hardware/?offset=20', (('limit', '20'),))
+
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    api = APIQuery('http://localhost', response_cache=cache)
+    api.transport.session = StatusSession([200])
+    api.single_query(next_link, endpoint='hardware')
+
+    urls = [row[0] for row in cache.connection.execute(
+        'SELECT url FROM responses')]
+    assert urls == ['http://localhost/hardware/?offset=20']
+
+
+def test_response_cache_revalidate(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    # every cached response is stale at once
+    endpoints = EndpointRegistry(profiles={'hardware': {'cache_ttl': 1e-9}})
+    api = APIQuery('http://localhost', response_cache=cache,
+                   endpoints=endpoints)
+    api.transport.session = StatusSession([200, 304],
+                                          headers={'ETag': '"v1"'})
+
+    for _ in range(2):
+        result = api.single_query('http://localhost/hardware/1',
+                                  endpoint='hardware')
+        assert result == {'objects': []}
+
+    request_headers = api.transport.session.request_headers
+    assert 'If-None-Match' not in request_headers[0]
+    assert request_headers[1]['If-None-Match'] == '"v1"'
+
+
+class TailSession(object):
+    """
+    Reply at once except for the given request which hangs.
+    """
+
+    def __init__(self, slow_request):
+        self.slow_request = slow_request
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if count == self.slow_request:
+            time.sleep(2)
+        return make_response({'count': count})
+
+
+def test_hedge_slow_request():
+    api = APIQuery('http://localhost', hedge=True, hedge_ratio=0.5)
+    api.transport.session = TailSession(slow_request=21)
+
+    for _ in range(20):
+        api.single_query('http://localhost/hardware/1', endpoint='hardware')
+
+    begin = time.monotonic()
+    result = api.single_query('http://localhost/hardware/1',
+                              endpoint='hardware')
+
+    assert time.monotonic() - begin < 1
+    assert result == {'count': 22}
+    assert api.hedged_count == 1
+
+
+def test_circuit_breaker_fail_fast():
+    api = APIQuery('http://localhost', max_retries=10, backoff_max=0,
+                   breaker_threshold=3, breaker_cooldown=60)
+    api.transport.session = StatusSession([500] * 10)
+
+    with pytest.raises(CircuitOpenError):
+        api.single_query('http://localhost/hardware/1', endpoint='hardware')
+    assert api.transport.session.count == 3
+
+    # other endpoints are not affected
+    api.transport.session = StatusSession([200])
+    api.single_query('http://localhost/locations/', endpoint='locations')
+
+
+def test_circuit_breaker_half_open():
+    breaker = CircuitBreaker('hardware', threshold=1, cooldown=0)
+    breaker.record(True)
+
+    assert breaker.before()
+    # only one probe at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+    breaker.record(False, probe=True)
+    assert not breaker.before()
+
+
+class TruncatedSession(object):
+    """
+    Cut the body of the first count responses short.
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+    def request(self, method, url, params=None, **kwargs):
+        if self.count > 0:
+            self.count -= 1
+            raise requests.exceptions.ChunkedEncodingError('truncated page')
+        return make_response({'objects': []})
+
+
+def test_circuit_breaker_recovers_from_truncated_responses():
+    api = APIQuery('http://localhost', max_retries=5, backoff_max=0,
+                   breaker_threshold=1, breaker_cooldown=0)
+    api.transport.session = TruncatedSession(3)
+
+    assert api.single_query('http://localhost/hardware/1',
+                            endpoint='hardware') == {'objects': []}
+    breaker = api.breakers['hardware']
+    assert breaker.probes_in_flight == 0
+    assert breaker.opened_at is None
+
+
+def test_transfer_stats():
+    api = APIQuery('http://localhost')
+    api.transport.session = StatusSession([200, 200],
+                                          headers={'Content-Length': '7'})
+
+    api.single_query('http://localhost/hardware/1', endpoint='hardware')
+    api.single_query('http://localhost/hardware/2', endpoint='hardware')
+
+    body_bytes = len(b'{"objects": []}') * 2
+    assert api.stats.summary() == [('hardware', 2, 14, body_bytes)]
+
+
+class CountingSession(object):
+    """
+    Count the requests in flight and keep their timeouts.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.timeouts = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.timeouts.append(kwargs.get('timeout'))
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        return make_response({'url': url})
+
+
+def test_endpoint_profiles():
+    config = configparser.ConfigParser()
+    config.read_string('''
+[API]
+hardware = /api/v1/hardware/
+hardware.timeout = 5, 20
+hardware.retries = 2
+machineReport.ttl = 600
+hardware.concurrency = 2
+''')
+    endpoints = EndpointRegistry.from_config(config['API'], timeout=10,
+                                             max_retries=3)
+
+    hardware = endpoints.get('hardware')
+    assert hardware.timeout == (5.0, 20.0)
+    assert hardware.max_retries == 2
+    assert hardware.cache_ttl == 300
+    assert endpoints.get('machineReport').cache_ttl == 600
+    assert endpoints.get('machineReport').timeout == (10, 60)
+    assert endpoints.get('unknown').timeout == (10, 10)
+    assert endpoints.get(None).max_retries == 3
+
+    api = APIQuery('http://localhost', max_workers=6, endpoints=endpoints)
+    api.transport.session = CountingSession()
+    urls = ['http://localhost/hardware/{}'.format(index)
+            for index in range(6)]
+    api.map_single_query(urls, endpoint='hardware')
+
+    assert api.transport.session.max_in_flight == 2
+    assert api.transport.session.timeouts == [(5.0, 20.0)] * 6
+
+
+class GatedSession(object):
+    """
+    Hold the first request until released and keep the order of the rest.
+    """
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.urls.append(url)
+            first = len(self.urls) == 1
+        if first:
+            self.gate.wait()
+        return make_response({'url': url})
+
+
+def test_endpoint_cap_priority():
+    endpoints = EndpointRegistry(profiles={'hardware': {'concurrency': 1}})
+    api = APIQuery('http://localhost', endpoints=endpoints)
+    api.transport.session = GatedSession()
+    limiter = api._endpoint_slot('hardware')
+
+    def query(name, priority):
+        api._send('GET', 'http://localhost/' + name, endpoint='hardware',
+                  priority=priority)
+
+    threads = []
+    for name, priority in [('first', INTERACTIVE), ('bulk', BULK),
+                           ('interactive', INTERACTIVE)]:
+        thread = threading.Thread(target=query, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        # queue the requests in order
+        while len(api.transport.session.urls) + len(limiter.waiters) < \
+                len(threads):
+            time.sleep(0.001)
+
+    api.transport.session.gate.set()
+    for thread in threads:
+        thread.join()
+
+    # the interactive request overtakes the bulk one queued before it
+    assert api.transport.session.urls == ['http://localhost/first',
+                                          'http://localhost/interactive',
+                                          'http://localhost/bulk']
+
+
+def test_map_query_deferred_retry():
+    api = APIQuery('http://localhost', max_workers=2)
+    calls = []
+
+    def flaky(item):
+        calls.append(item)
+        if item == 'gone':
+            raise QueryError('not found', 404)
+        if item == 'blip' and calls.count(item) == 1:
+            raise QueryError('connection reset')
+        return item.upper()
+
+    results = api.map_query_deferred(flaky, ['a', 'blip', 'gone', 'b'],
+                                     retry_delay=0)
+
+    assert results[0] == 'A'
+    assert results[1] == 'BLIP'
+    assert isinstance(results[2], QueryError)
+    assert results[3] == 'B'
+    # the blip is retried after the rest, the missing item never again
+    assert calls.count('blip') == 2
+    assert calls.count('gone') == 1
+    assert calls[-1] == 'blip'
+
+
+def test_map_query_deferred_waits_for_open_circuit():
+    api = APIQuery('http://localhost', max_retries=1, backoff_max=0,
+                   breaker_threshold=1, breaker_cooldown=0.3)
+    api.transport.session = StatusSession([500, 200, 200])
+
+    def query(item):
+        return api.single_query('http://localhost/hardware/' + item,
+                                endpoint='hardware')
+
+    begin = time.monotonic()
+    results = api.map_query_deferred(query, ['a', 'b'], retry_delay=0)
+
+    # b hits the circuit opened by a, and both are retried after cooldown
+    assert results == [{'objects': []}, {'objects': []}]
+    assert time.monotonic() - begin >= 0.3
+
+
+def test_record_replay(tmp_path):
+    api = APIQuery('http://localhost', max_workers=2, checkpoint_dir=None)
+    api.transport.session = FakeSession(total_count=10, limit=3)
+    api.transport.record(str(tmp_path))
+    recorded = api.batch_query('http://localhost/list/',
+                               params={'api_key': 'secret'})
+
+    replay_api = APIQuery('http://localhost', max_workers=2,
+                          checkpoint_dir=None)
+    replay_api.transport.replay(str(tmp_path))
+    replayed = replay_api.batch_query('http://localhost/list/',
+                                      params={'api_key': 'other'})
+
+    assert replayed == recorded == list(range(10))
+    with pytest.raises(QueryError) as excinfo:
+        replay_api.single_query('http://localhost/unknown/')
+    assert excinfo.value.status_code == 404
+
+
+def test_request_stats():
+    api = APIQuery('http://localhost', backoff_max=0.01)
+    api.transport.session = StatusSession([503, 200, 404])
+
+    api.single_query('http://localhost/hardware/1', endpoint='hardware')
+    with pytest.raises(QueryError):
+        api.single_query('http://localhost/hardware/2', endpoint='hardware')
+
+    report = api.stats.report()['hardware']
+    assert report['requests'] == 3
+    assert report['retries'] == 1
+    assert report['status_codes'] == {'200': 1, '404': 1, '503': 1}
+    latency = report['latency']
+    assert 0 <= latency['p50'] <= latency['p99'] <= latency['max']
+    assert sum(count for _, count in latency['buckets']) == 3
+    assert 'hardware' in api.stats.format_report()
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for latency in range(1, 1001):
+        histogram.add(latency / 1000.0)
+
+    # within the relative error of the bucket width
+    assert abs(histogram.percentile(50) - 0.5) <= 0.5 / 16
+    assert abs(histogram.percentile(99) - 0.99) <= 0.99 / 16
+    assert histogram.percentile(100) == 1.0
+    assert histogram.count == 1000
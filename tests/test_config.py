@@ -47,3 +47,24 @@ def test_read_default_verbose(config_singlet):
 def test_read_default_cache(config_singlet):
     answer = 'true'
     assert config_singlet.config['GENERAL']['cache'] == answer
+
+
+def test_response_cache_of_user_conf(tmpdir, monkeypatch):
+    """
+    A user conf without [CACHE] still gets the default response cache.
+    """
+    import os
+    from configparser import ConfigParser
+    from c3.commands.c3_cli import get_response_cache
+
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), 'data',
+                             'test_conf.ini'))
+    monkeypatch.chdir(str(tmpdir))
+
+    assert not config.has_section('CACHE')
+    assert get_response_cache(config).path == 'c3-response-cache.sqlite'
+    assert get_response_cache(config, http_cache=False) is None
+
+    config['CACHE'] = {'path': 'responses.sqlite'}
+    assert get_response_cache(config).path == 'responses.sqlite'
@@ -0,0 +1,32 @@
+from c3.json import decode
+
+
+certificate = {'id': 1,
+               'machine': '/api/v1/hardware/201404-14986/',
+               'report': None,
+               'release': {'release': '16.04 LTS', 'codename': 'xenial'},
+               'level': 'Enabled'}
+
+
+def test_loads():
+    assert decode.loads(b'{"objects": [1, 2]}') == {'objects': [1, 2]}
+
+
+def test_project_nested_field():
+    projected = decode.project(certificate,
+                               ['machine', 'report', 'release.release',
+                                'status'])
+
+    assert projected == {'machine': '/api/v1/hardware/201404-14986/',
+                         'report': None,
+                         'release': {'release': '16.04 LTS'}}
+
+
+def test_project_document_objects():
+    document = {'meta': {'next': None}, 'objects': [certificate]}
+
+    projected = decode.project_document(document, ['level'])
+
+    assert projected == {'meta': {'next': None},
+                         'objects': [{'level': 'Enabled'}]}
+    assert decode.project_document(document) is document
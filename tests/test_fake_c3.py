@@ -0,0 +1,225 @@
+import json
+import configparser
+import pytest
+import c3.config as c3config
+import c3.api.api as c3api
+import c3.api.query as c3query
+import c3.api.cids as c3cids
+import c3.pool.cid as c3cid
+from c3.api.api_utils import APIQuery, QueryError
+from c3.testing import fake_c3
+from c3.testing.fake_c3 import FakeC3Data, FakeC3Server, FaultPolicy
+
+
+@pytest.fixture
+def server():
+    server = FakeC3Server(FakeC3Data(cid_count=50), page_size=7).start()
+    yield server
+    server.stop()
+
+
+def test_certificates_by_location(server):
+    api = APIQuery(server.url, max_workers=4, checkpoint_dir=None)
+
+    certificates = api.batch_query(
+        server.url + '/api/v1/certificates/?machine__location=13',
+        params={'username': 'ubuntu', 'api_key': 'ubuntu'})
+
+    expected = server.data.certificates_by_location('13')
+    assert len(expected) > 7
+    assert certificates == json.loads(json.dumps(expected))
+
+
+def test_hardware_patch(server):
+    api = APIQuery(server.url)
+    cid = sorted(server.data.hardware)[0]
+    url = server.url + '/api/v1/hardware/' + cid
+
+    api.push(url + '/', data=json.dumps({'location': '/api/v1/locations/8/'}))
+
+    assert api.single_query(url)['location']['name'] == 'oem'
+
+
+def test_report_devices(server):
+    api = APIQuery(server.url)
+    report_id = sorted(server.data.reports)[0]
+
+    report = api.single_query(server.url + '/api/v1/machinereports/find/',
+                              params={'id': report_id})
+    devices = api.single_query(
+        server.url + '/api/v1/machinereports/{}/report_devices/'.format(
+            report_id))
+
+    assert report['objects'][0]['id'] == report_id
+    assert len(devices['objects']) == 5
+
+
+def test_injected_errors():
+    server = FakeC3Server(FakeC3Data(cid_count=1),
+                          FaultPolicy(error_rate=1.0)).start()
+    try:
+        api = APIQuery(server.url, max_retries=2, backoff_max=0.01)
+        with pytest.raises(QueryError):
+            api.single_query(server.url + '/api/v1/locations/')
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def use_server(monkeypatch):
+    """
+    Point the configuration and the api singletons to a server. They are
+    restored after the test.
+    """
+    def point_to(server):
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config['C3'] = {'URI': server.url, 'UserName': 'ubuntu',
+                        'APIKey': 'ubuntu', 'BatchQueryMode': '0'}
+        config['API'] = fake_c3.api_paths
+        monkeypatch.setattr(c3config.Configuration.get_instance(), 'config',
+                            config)
+        api_instance = c3api.API.get_instance()
+        monkeypatch.setattr(api_instance, 'api',
+                            APIQuery(server.url, max_workers=2,
+                                     checkpoint_dir=None))
+        monkeypatch.setattr(api_instance, 'request_params',
+                            {'username': 'ubuntu', 'api_key': 'ubuntu'})
+
+    return point_to
+
+
+def test_query_hardware_bulk(server, use_server):
+    use_server(server)
+    cids = sorted(server.data.hardware)[:5] + ['200001-0']
+
+    hardwares = c3query.query_hardware_bulk(cids, chunk=2)
+
+    assert [hardwares[cid]['canonical_id'] for cid in cids[:5]] == cids[:5]
+    assert hardwares['200001-0'].status_code == 404
+
+
+def test_build_cids_from_submissions(server, use_server):
+    use_server(server)
+    submission_ids = [str(report_id)
+                      for report_id in sorted(server.data.reports)[:4]]
+
+    cids = c3cid.build_cids_from_submissions(submission_ids + ['1'])
+
+    for submission_id, cid in zip(submission_ids, cids):
+        report = server.data.reports[int(submission_id)]
+        assert cid.model == report['model']
+        assert cid.kernel == report['kernel']
+        assert cid.audio_name in [device['name'] for device
+                                  in server.data.devices[int(submission_id)]]
+    # no such submission
+    assert cids[-1].model == 'NA'
+
+
+def test_iter_submission_devices_bulk(server, use_server):
+    use_server(server)
+    submission_ids = [str(report_id)
+                      for report_id in sorted(server.data.reports)[:6]]
+
+    # pages of 7 rows cut through the 5 devices of every report
+    devices = list(c3query.iter_submission_devices_bulk(submission_ids,
+                                                        chunk=4))
+
+    assert [submission_id for submission_id, _ in devices] == submission_ids
+    for submission_id, rows in devices:
+        expected = server.data.devices[int(submission_id)]
+        assert [row['name'] for row in rows] == \
+            [device['name'] for device in expected]
+
+
+@pytest.mark.parametrize('filtering', [True, False])
+def test_certificates_filters(filtering, use_server):
+    server = FakeC3Server(FakeC3Data(cid_count=50), page_size=7,
+                          filtering=filtering).start()
+    try:
+        use_server(server)
+        sample = server.data.certificates_by_location('13')[0]
+        release = sample['release']['release']
+        filters = {'release__release': release, 'level': sample['level']}
+
+        certificates = c3query.query_certificates_by_location('cert-taipei',
+                                                              filters)
+    finally:
+        server.stop()
+
+    matched = [certificate for certificate in certificates
+               if certificate['release']['release'] == release and
+               certificate['level'] == filters['level']]
+    assert matched
+    # every certificate is downloaded if the filters are rejected
+    assert (certificates == matched) == filtering
+
+
+def test_sync_certificates(server, tmpdir, monkeypatch, use_server):
+    monkeypatch.chdir(str(tmpdir))
+    use_server(server)
+    c3config.Configuration.get_instance().config['GENERAL'] = {
+        'cache': 'true', 'cache_sync': 'false'}
+    certificates = c3cids.get_certificates_by_location('cert-taipei')
+
+    changed = certificates[0]
+    server.data.update_certificate(changed['id'],
+                                   {'status': 'Complete - Fail'})
+    cid = changed['machine'].split('/')[-2]
+    added = server.data.add_certificate(cid, '18.04 LTS', 'Certified')
+
+    assert c3cids.get_certificates_by_location('cert-taipei') == \
+        certificates
+    synced = c3cids.get_certificates_by_location('cert-taipei', sync=True)
+
+    assert len(synced) == len(certificates) + 1
+    assert synced[0]['status'] == 'Complete - Fail'
+    assert synced[-1]['resource_uri'] == added['resource_uri']
+    # the sync is kept in the cache
+    assert c3cids.get_certificates_by_location('cert-taipei') == synced
+    assert c3cids.get_certificates_high_water(synced) == \
+        {'updated_at__gte': added['updated_at']}
+
+
+def test_sync_filtered_certificates(server, tmpdir, monkeypatch, use_server):
+    monkeypatch.chdir(str(tmpdir))
+    use_server(server)
+    c3config.Configuration.get_instance().config['GENERAL'] = {
+        'cache': 'true', 'cache_sync': 'true'}
+    sample = server.data.certificates_by_location('13')[0]
+    release = sample['release']['release']
+    filters = {'release__release': release}
+    certificates = c3cids.get_certificates_by_location('cert-taipei',
+                                                       filters=filters)
+
+    cid = sample['machine'].split('/')[-2]
+    other_release = '18.04 LTS' if release != '18.04 LTS' else '16.04 LTS'
+    server.data.add_certificate(cid, other_release, 'Certified')
+    added = server.data.add_certificate(cid, release, 'Certified')
+    synced = c3cids.get_certificates_by_location('cert-taipei',
+                                                 filters=filters)
+
+    # the filters are applied to the sync too
+    assert synced[:-1] == certificates
+    assert synced[-1]['resource_uri'] == added['resource_uri']
+
+
+def test_sync_drops_certificates_leaving_filters(server, tmpdir, monkeypatch,
+                                                 use_server):
+    monkeypatch.chdir(str(tmpdir))
+    use_server(server)
+    c3config.Configuration.get_instance().config['GENERAL'] = {
+        'cache': 'true', 'cache_sync': 'true'}
+    filters = {'status': 'Complete - Pass'}
+    certificates = c3cids.get_certificates_by_location('cert-taipei',
+                                                       filters=filters)
+
+    failed = certificates[0]
+    server.data.update_certificate(failed['id'],
+                                   {'status': 'Complete - Fail'})
+    synced = c3cids.get_certificates_by_location('cert-taipei',
+                                                 filters=filters)
+
+    assert synced == certificates[1:]
+    assert c3cids.get_certificates_by_location('cert-taipei',
+                                               filters=filters) == synced
@@ -0,0 +1,87 @@
+import time
+import threading
+import requests
+from c3.api import throttle
+
+
+def test_token_bucket_rate():
+    bucket = throttle.TokenBucket(rate=50, burst=1)
+
+    begin = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    elapsed = time.monotonic() - begin
+
+    # one token in the bucket and ten more at 50 tokens per second
+    assert elapsed >= 0.18
+
+
+def test_backoff_delay_cap():
+    for tries in range(1, 20):
+        assert 0 <= throttle.backoff_delay(tries, base=0.5, cap=4) <= 4
+
+
+def test_retry_after_delay():
+    response = requests.models.Response()
+    assert throttle.retry_after_delay(response) is None
+
+    response.headers['Retry-After'] = '7'
+    assert throttle.retry_after_delay(response) == 7
+
+    response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert throttle.retry_after_delay(response) == 0
+
+
+def test_aimd_additive_increase():
+    controller = throttle.AIMDController(max_window=4)
+
+    for _ in range(20):
+        controller.record(time.monotonic(), 0.1, False)
+
+    assert controller.window == 4
+
+
+def test_aimd_multiplicative_decrease():
+    controller = throttle.AIMDController(max_window=16)
+    controller.current_window = 16
+    started_at = time.monotonic()
+
+    controller.record(started_at, 1.0, True)
+    # requests sent before the cut do not cut again
+    controller.record(started_at, 1.0, True)
+
+    assert controller.window == 8
+
+    controller.record(time.monotonic(), 1.0, True)
+
+    assert controller.window == 4
+
+
+def test_concurrency_limiter_priority():
+    limiter = throttle.ConcurrencyLimiter(limit=1)
+    limiter.acquire()
+    served = []
+
+    def wait_for_slot(name, priority):
+        limiter.acquire(priority)
+        served.append(name)
+        limiter.release()
+
+    threads = []
+    waiters = [('bulk-{}'.format(index), throttle.BULK)
+               for index in range(4)] + [('interactive', throttle.INTERACTIVE)]
+    for name, priority in waiters:
+        thread = threading.Thread(target=wait_for_slot,
+                                  args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        # queue the waiters in order
+        while len(limiter.waiters) < len(threads):
+            time.sleep(0.001)
+
+    limiter.release()
+    for thread in threads:
+        thread.join()
+
+    # the interactive waiter overtakes the bulk ones queued before it
+    assert served == ['interactive', 'bulk-0', 'bulk-1', 'bulk-2', 'bulk-3']